@@ -0,0 +1,114 @@
+from datetime import timezone
+from itertools import islice
+from typing import Awaitable, Callable, Iterable, Iterator, List, Tuple, Union
+from pydantic import ValidationError
+from models import ImportedPost
+
+
+def parse_posts(
+    lines: Iterable[Union[str, bytes]],
+) -> Iterator[Tuple[int, Union[ImportedPost, str]]]:
+    """
+    Parses NDJSON posts, blank lines are skipped.
+
+    Returns:
+        (line number, post) pairs, the post is an error message for the lines
+        that are not valid posts.
+    """
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, ImportedPost.model_validate_json(line)
+        except ValidationError as e:
+            error = e.errors()[0]
+            location = ".".join(str(part) for part in error["loc"])
+            message = f"{location}: {error['msg']}" if location else error["msg"]
+            yield line_number, message
+
+
+async def import_posts(
+    db,
+    lines: Iterable[Union[str, bytes]],
+    batch_size: int = 5000,
+    store_image: Callable[[str], Awaitable[str]] = None,
+    release_image: Callable[[str], Awaitable[None]] = None,
+) -> List[dict]:
+    """
+    Imports NDJSON posts, one transaction per batch of ``batch_size`` lines.
+
+    Refs stay valid across batches, so a reply can come in a later batch than
+    its thread.
+
+    Args:
+        db: An AsyncDatabaseManager or one of its units of work.
+        lines: The NDJSON lines.
+        batch_size: Number of lines inserted per transaction.
+        store_image: Stores the image file named by a post and returns its id,
+            raising ValueError when it cannot. None rejects posts with images.
+        release_image: Undoes store_image for an image id no imported post
+            uses, e.g. when the database rejected its posts.
+
+    Returns:
+        One dict per post, in order: {"line": int, "post_id": int} or
+        {"line": int, "error": str}.
+    """
+    refs = {}
+    images = {}
+    results = []
+
+    parsed = parse_posts(lines)
+    while batch := list(islice(parsed, batch_size)):
+        rows = []
+        line_numbers = []
+        row_images = []
+        # names of the images stored for this batch
+        stored = []
+
+        for line_number, post in batch:
+            if isinstance(post, str):
+                results.append({"line": line_number, "error": post})
+                continue
+
+            if post.image is not None:
+                try:
+                    if store_image is None:
+                        raise ValueError("images are not accepted")
+                    if post.image not in images:
+                        images[post.image] = await store_image(post.image)
+                        stored.append(post.image)
+                except ValueError as e:
+                    results.append({"line": line_number, "error": str(e)})
+                    continue
+                post.image_uuid = images[post.image]
+
+            if post.date is not None and post.date.tzinfo is not None:
+                post.date = post.date.astimezone(timezone.utc).replace(tzinfo=None)
+
+            rows.append(post.model_dump(exclude={"image"}))
+            line_numbers.append(line_number)
+            row_images.append(post.image)
+
+        imported = []
+        try:
+            if rows:
+                imported = await db.import_posts(rows, refs=refs)
+        finally:
+            # the images are stored before the posts are checked, release the
+            # ones only rejected posts (or a failed batch) would have used
+            used = {
+                name
+                for name, result in zip(row_images, imported)
+                if "post_id" in result
+            }
+            for name in stored:
+                if name not in used:
+                    image_id = images.pop(name)
+                    if release_image is not None:
+                        await release_image(image_id)
+
+        for line_number, result in zip(line_numbers, imported):
+            results.append({"line": line_number, **result})
+
+    results.sort(key=lambda result: result["line"])
+    return results
@@ -0,0 +1,156 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+class CacheBackend:
+    """
+    Interface of the caches DatabaseManager reads through.
+
+    LRUCache is the in-process implementation. A cache shared between
+    processes (Redis, memcached...) can implement the same methods, keys are
+    strings and values are built from dicts, lists, strings and numbers, so
+    they can be serialized as JSON.
+    """
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        raise NotImplementedError
+
+    def set(self, key: Hashable, value: Any) -> bool:
+        raise NotImplementedError
+
+    def delete(self, key: Hashable):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+
+class NullCache(CacheBackend):
+    """
+    Stores nothing, every lookup is a miss.
+    """
+
+    def __init__(self):
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any) -> bool:
+        return False
+
+    def delete(self, key: Hashable):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"entries": 0, "hits": 0, "misses": self.misses}
+
+
+class LRUCache(CacheBackend):
+    """
+    Thread safe LRU cache bounded by the total size of its values.
+
+    Args:
+        max_bytes: Budget for the sum of the sizes of the cached values.
+        ttl: Seconds after which an entry is considered stale, None to keep
+            entries until they are evicted.
+        sizeof: Returns the size of a value, defaults to len.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl: float = None,
+        sizeof: Callable[[Any], int] = len,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # key -> (value, size, expiration)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, size, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> bool:
+        """
+        Stores a value, evicting the least recently used entries to make room.
+
+        Returns:
+            False if the value alone is larger than the budget and was not stored.
+        """
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return False
+
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            while self._entries and self.current_bytes + size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+            self._entries[key] = (value, size, expires_at)
+            self.current_bytes += size
+
+        return True
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -1,44 +1,49 @@
-from io import BytesIO
-from typing import Union
+from typing import Dict, Iterator, List, Tuple, Union
 import gzip
-import shutil
+import lzma
+import os
+import struct
+import zlib
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-def compress_bytes(data: bytes) -> bytes:
-    with BytesIO() as f_in:
-        f_in.write(data)
-        f_in.seek(0)
-        with BytesIO() as f_out:
-            with gzip.open(f_out, "wb") as f:
-                shutil.copyfileobj(f_in, f)
-            return f_out.getvalue()
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+
+def compress_bytes(data: bytes, level: int = 9) -> bytes:
+    # mtime=0 makes gzip.compress a single zlib call, and the output
+    # deterministic
+    return gzip.compress(data, compresslevel=level, mtime=0)
 
 
 def decompress_bytes(data: bytes) -> bytes:
-    with BytesIO(data) as f_in:
-        with BytesIO() as f_out:
-            with gzip.open(f_in, "rb") as f:
-                shutil.copyfileobj(f, f_out)
-            return f_out.getvalue()
+    return sniff_codec(data).decompress(data)
 
 
 def is_compressed_bytes(data: bytes) -> bool:
     """
-    Checks if a byte stream is compressed using the magic number of gzip format.
+    Checks if a byte stream is compressed with one of the known codecs, using
+    its magic number.
 
     Args:
-        data: The byte stream to check.
+        data: The byte stream to check, its first MAGIC_LENGTH bytes are enough.
 
     Returns:
         True if the data is compressed, False otherwise.
     """
-    return len(data) > 1 and data[:2] == b"\x1f\x8b"  # Check for gzip magic number
+    return sniff_codec(data).name != "raw"
 
 
 def is_compressed(file: Union[str, bytes]) -> bool:
     if isinstance(file, str):
         with open(file, "rb") as f_in:
-            data = f_in.read()
+            data = f_in.read(MAGIC_LENGTH)
     else:
         data = file
 
@@ -92,3 +97,448 @@ def decompress_file(
             f_out.write(decompressed_data)
 
     return decompressed_data
+
+
+def iter_decompress_file(file: str, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """
+    Decompresses a gzip file chunk by chunk, without holding the whole
+    decompressed content in memory.
+
+    Args:
+        file: The path of the compressed file.
+        chunk_size: Size of the decompressed chunks.
+
+    Yields:
+        The decompressed chunks.
+    """
+    with gzip.open(file, "rb") as f_in:
+        while chunk := f_in.read(chunk_size):
+            yield chunk
+
+
+def gzip_uncompressed_size(file: str) -> int:
+    """
+    Reads the decompressed size stored in the trailer of a single member gzip
+    file (ISIZE field, the size modulo 2^32).
+    """
+    with open(file, "rb") as f_in:
+        f_in.seek(-4, os.SEEK_END)
+        return int.from_bytes(f_in.read(4), "little")
+
+
+# dictzip compatible random access gzip: the deflate stream is fully flushed
+# every DICTZIP_CHUNK_LENGTH uncompressed bytes and the compressed size of each
+# chunk is stored in an "RA" subfield of the gzip header, so any chunk can be
+# inflated on its own while the file stays a plain single member gzip.
+DICTZIP_CHUNK_LENGTH = 58315
+
+
+def compress_bytes_seekable(
+    data: bytes,
+    chunk_length: int = DICTZIP_CHUNK_LENGTH,
+    level: int = zlib.Z_DEFAULT_COMPRESSION,
+) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    view = memoryview(data)
+    chunks = []
+
+    for offset in range(0, len(data), chunk_length):
+        chunk = compressor.compress(view[offset : offset + chunk_length])
+        if offset + chunk_length >= len(data):
+            chunk += compressor.flush(zlib.Z_FINISH)
+        else:
+            chunk += compressor.flush(zlib.Z_FULL_FLUSH)
+        chunks.append(chunk)
+
+    if not chunks:
+        chunks.append(compressor.flush(zlib.Z_FINISH))
+
+    ra_data = struct.pack("<HHH", 1, chunk_length, len(chunks)) + b"".join(
+        struct.pack("<H", len(c)) for c in chunks
+    )
+    if len(ra_data) + 4 > 0xFFFF:
+        # the index does not fit in the gzip header, store without it
+        return compress_bytes(data, level if level >= 0 else 6)
+    extra = b"RA" + struct.pack("<H", len(ra_data)) + ra_data
+
+    header = (
+        b"\x1f\x8b\x08\x04"  # magic, deflate, FEXTRA
+        + struct.pack("<I", 0)  # mtime
+        + b"\x00\xff"  # xfl, unknown os
+        + struct.pack("<H", len(extra))
+        + extra
+    )
+    trailer = struct.pack("<II", zlib.crc32(data), len(data) & 0xFFFFFFFF)
+
+    return header + b"".join(chunks) + trailer
+
+
+def read_seekable_index(f) -> Union[Tuple[int, int, List[int]], None]:
+    """
+    Reads the random access index of a dictzip gzip file.
+
+    Args:
+        f: The file, opened in binary mode, it is left at an undefined position.
+
+    Returns:
+        (chunk length, offset of the deflate data, compressed chunk offsets
+        relative to it), or None if the file has no index.
+    """
+    f.seek(0)
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b"\x1f\x8b\x08" or not header[3] & 0x04:
+        return None
+    # names and comments would move the deflate data, dictzip files have none
+    if header[3] & 0x1A:
+        return None
+
+    (xlen,) = struct.unpack("<H", f.read(2))
+    extra = f.read(xlen)
+    data_offset = 12 + xlen
+
+    pos = 0
+    while pos + 4 <= len(extra):
+        si = extra[pos : pos + 2]
+        (length,) = struct.unpack("<H", extra[pos + 2 : pos + 4])
+        field = extra[pos + 4 : pos + 4 + length]
+        pos += 4 + length
+        if si != b"RA" or len(field) < 6:
+            continue
+
+        version, chunk_length, count = struct.unpack("<HHH", field[:6])
+        if version != 1 or len(field) < 6 + 2 * count:
+            return None
+        sizes = struct.unpack(f"<{count}H", field[6 : 6 + 2 * count])
+
+        offsets = [0]
+        for size in sizes:
+            offsets.append(offsets[-1] + size)
+        return chunk_length, data_offset, offsets
+
+    return None
+
+
+def iter_decompress_range(
+    file: str, start: int, end: int, chunk_size: int = 64 * 1024
+) -> Iterator[bytes]:
+    """
+    Decompresses the bytes in [start, end) of a gzip file.
+
+    Dictzip files (see compress_bytes_seekable) only inflate the chunks that
+    overlap the range, other gzip files are inflated from the start and the
+    bytes before the range are discarded.
+
+    Args:
+        file: The path of the compressed file.
+        start: First decompressed byte to return.
+        end: One past the last decompressed byte to return.
+        chunk_size: Size of the compressed reads.
+
+    Yields:
+        The decompressed chunks.
+    """
+    with open(file, "rb") as f_in:
+        index = read_seekable_index(f_in)
+
+        if index is None:
+            f_in.seek(0)
+            decompressor = zlib.decompressobj(31)
+            position = 0
+        else:
+            chunk_length, data_offset, offsets = index
+            first = min(start // chunk_length, len(offsets) - 1)
+            f_in.seek(data_offset + offsets[first])
+            decompressor = zlib.decompressobj(-15)
+            position = first * chunk_length
+
+        while position < end:
+            compressed = f_in.read(chunk_size)
+            if not compressed:
+                break
+            data = decompressor.decompress(compressed)
+
+            if position + len(data) > start:
+                yield data[max(start - position, 0) : end - position]
+            position += len(data)
+
+            if decompressor.eof:
+                break
+
+
+
+class Codec:
+    """
+    A compression format of stored files.
+
+    Stored files end with the extension of their codec, so reads always know
+    how to decode them. ``content_coding`` is the HTTP Content-Encoding of the
+    format, when browsers can decode it themselves.
+
+    Args:
+        level: The compression level, None for the default of the format.
+    """
+
+    name = None
+    extension = None
+    magic = None
+    content_coding = None
+    default_level = None
+
+    def __init__(self, level: int = None):
+        self.level = self.default_level if level is None else level
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompressobj(self):
+        """
+        Returns an object whose ``decompress(chunk)`` inflates a stream piece
+        by piece.
+        """
+        raise NotImplementedError
+
+    def uncompressed_size(self, file: str) -> Union[int, None]:
+        # None when the format does not record it
+        return None
+
+    def iter_decompress(
+        self, file: str, chunk_size: int = 64 * 1024
+    ) -> Iterator[bytes]:
+        decompressor = self.decompressobj()
+        with open(file, "rb") as f_in:
+            while compressed := f_in.read(chunk_size):
+                data = decompressor.decompress(compressed)
+                if data:
+                    yield data
+
+    def iter_decompress_range(
+        self, file: str, start: int, end: int, chunk_size: int = 64 * 1024
+    ) -> Iterator[bytes]:
+        position = 0
+        for data in self.iter_decompress(file, chunk_size):
+            if position + len(data) > start:
+                yield data[max(start - position, 0) : end - position]
+            position += len(data)
+            if position >= end:
+                break
+
+
+class RawCodec(Codec):
+    name = "raw"
+    extension = ""
+    magic = b""
+
+    class _Identity:
+        @staticmethod
+        def decompress(data: bytes) -> bytes:
+            return data
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+    def decompressobj(self):
+        return self._Identity()
+
+    def uncompressed_size(self, file: str) -> int:
+        return os.path.getsize(file)
+
+
+class GzipCodec(Codec):
+    """
+    Dictzip flavored gzip, see compress_bytes_seekable: any gzip reader can
+    decode it and ranges only inflate the chunks they overlap.
+    """
+
+    name = "gzip"
+    extension = ".gz"
+    magic = b"\x1f\x8b"
+    content_coding = "gzip"
+    default_level = 6
+
+    def compress(self, data: bytes) -> bytes:
+        return compress_bytes_seekable(data, level=self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return gzip.decompress(data)
+
+    def decompressobj(self):
+        return zlib.decompressobj(31)
+
+    def uncompressed_size(self, file: str) -> int:
+        return gzip_uncompressed_size(file)
+
+    def iter_decompress_range(
+        self, file: str, start: int, end: int, chunk_size: int = 64 * 1024
+    ) -> Iterator[bytes]:
+        return iter_decompress_range(file, start, end, chunk_size)
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+    extension = ".zz"
+    # deflate with a 32K window and any level, the second byte depends on it
+    magic = b"\x78"
+    # HTTP "deflate" is the zlib format
+    content_coding = "deflate"
+    default_level = 6
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+    def decompressobj(self):
+        return zlib.decompressobj()
+
+
+class LzmaCodec(Codec):
+    name = "lzma"
+    extension = ".xz"
+    magic = b"\xfd7zXZ\x00"
+    default_level = 6
+
+    def compress(self, data: bytes) -> bytes:
+        return lzma.compress(data, preset=self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lzma.decompress(data)
+
+    def decompressobj(self):
+        return lzma.LZMADecompressor()
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    extension = ".zst"
+    magic = b"\x28\xb5\x2f\xfd"
+    content_coding = "zstd"
+    default_level = 3
+
+    def compress(self, data: bytes) -> bytes:
+        # the frame records the content size
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    def decompressobj(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    def uncompressed_size(self, file: str) -> Union[int, None]:
+        with open(file, "rb") as f_in:
+            size = zstandard.frame_content_size(f_in.read(18))
+        return size if size >= 0 else None
+
+
+class Lz4Codec(Codec):
+    name = "lz4"
+    extension = ".lz4"
+    magic = b"\x04\x22\x4d\x18"
+    default_level = 0
+
+    def compress(self, data: bytes) -> bytes:
+        return lz4_frame.compress(
+            data, compression_level=self.level, store_size=True
+        )
+
+    def decompress(self, data: bytes) -> bytes:
+        return lz4_frame.decompress(data)
+
+    def decompressobj(self):
+        return lz4_frame.LZ4FrameDecompressor()
+
+    def uncompressed_size(self, file: str) -> Union[int, None]:
+        # magic, FLG, BD, then the content size when FLG has bit 3 set
+        with open(file, "rb") as f_in:
+            header = f_in.read(14)
+        if len(header) < 14 or not header[4] & 0x08:
+            return None
+        return int.from_bytes(header[6:14], "little")
+
+
+CODECS: Dict[str, type] = {
+    "raw": RawCodec,
+    "gzip": GzipCodec,
+    "zlib": ZlibCodec,
+    "lzma": LzmaCodec,
+}
+# optional backends, only when their package is installed
+if zstandard is not None:
+    CODECS["zstd"] = ZstdCodec
+if lz4_frame is not None:
+    CODECS["lz4"] = Lz4Codec
+
+MAGIC_LENGTH = max(len(codec.magic) for codec in CODECS.values())
+
+
+def get_codec(name: str, level: int = None) -> Codec:
+    if name not in CODECS:
+        raise ValueError(
+            f"unknown or unavailable codec: {name}, available: {', '.join(CODECS)}"
+        )
+    return CODECS[name](level)
+
+
+def codec_for_path(path: str) -> Codec:
+    """
+    Returns the codec recorded by the extension of a stored file.
+    """
+    for codec in CODECS.values():
+        if codec.extension and path.endswith(codec.extension):
+            return codec()
+    return RawCodec()
+
+
+def sniff_codec(header: bytes) -> Codec:
+    """
+    Guesses the codec of data from its first MAGIC_LENGTH bytes, for data
+    that did not come with its codec.
+    """
+    for codec in CODECS.values():
+        if not codec.magic or not header.startswith(codec.magic):
+            continue
+        # a lone 0x78 is a weak magic, also check the zlib header checksum
+        if codec is ZlibCodec and (
+            len(header) < 2 or (header[0] << 8 | header[1]) % 31
+        ):
+            continue
+        return codec()
+    return RawCodec()
+
+
+def compress_if_worth_it(
+    data: bytes,
+    codec: Codec,
+    min_saving: float = 0.05,
+    sample_size: int = 64 * 1024,
+) -> Tuple[Codec, bytes]:
+    """
+    Compresses data unless it does not shrink by at least ``min_saving``.
+
+    Already compressed content (WebP, JPEG, PNG...) barely shrinks, so large
+    inputs are first judged on a sample of ``sample_size`` bytes and only
+    compressed entirely when the sample is worth it.
+
+    Returns:
+        (the codec used, RawCodec when stored as is; the stored bytes)
+    """
+    if codec.name == "raw":
+        return codec, data
+
+    limit = 1 - min_saving
+    if len(data) > sample_size:
+        sample = memoryview(data)[:sample_size]
+        if len(codec.compress(sample)) > sample_size * limit:
+            return RawCodec(), data
+
+    compressed = codec.compress(data)
+    if len(compressed) > len(data) * limit:
+        return RawCodec(), data
+    return codec, compressed
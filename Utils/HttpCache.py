@@ -0,0 +1,102 @@
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Mapping, Tuple, Union
+
+
+def http_date(timestamp: float) -> str:
+    return formatdate(timestamp, usegmt=True)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Weak comparison of an If-None-Match header against an ETag, as required
+    for conditional GET and HEAD requests.
+    """
+    if if_none_match.strip() == "*":
+        return True
+
+    etag = etag.removeprefix("W/")
+    for candidate in if_none_match.split(","):
+        if candidate.strip().removeprefix("W/") == etag:
+            return True
+
+    return False
+
+
+def is_not_modified(
+    request_headers: Mapping[str, str], etag: str, last_modified: float
+) -> bool:
+    """
+    Checks whether a conditional request can be answered with 304 Not Modified.
+
+    If-Modified-Since is only looked at when there is no If-None-Match header.
+
+    Args:
+        request_headers: The headers of the request.
+        etag: The ETag of the representation that would be sent.
+        last_modified: The modification timestamp of the representation.
+
+    Returns:
+        True if the client copy is still valid.
+    """
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have a one second resolution
+        return int(last_modified) <= since
+
+    return False
+
+
+class RangeNotSatisfiableError(Exception):
+    pass
+
+
+def parse_range(range_header: str, size: int) -> Union[Tuple[int, int], None]:
+    """
+    Parses a single byte range of a Range header.
+
+    Args:
+        range_header: The value of the Range header.
+        size: The size of the full representation.
+
+    Returns:
+        (start, end) with end exclusive, or None when the header should be
+        ignored (malformed, other units or several ranges).
+
+    Raises:
+        RangeNotSatisfiableError: If the range does not overlap the content.
+    """
+    units, _, ranges = range_header.partition("=")
+    if units.strip().lower() != "bytes" or "," in ranges:
+        return None
+
+    first, sep, last = ranges.strip().partition("-")
+    if not sep:
+        return None
+
+    try:
+        if first == "":
+            # suffix range, the last n bytes
+            length = int(last)
+            if length <= 0:
+                raise RangeNotSatisfiableError(range_header)
+            return max(size - length, 0), size
+
+        start = int(first)
+        end = int(last) + 1 if last else size
+    except ValueError:
+        return None
+
+    if start >= size:
+        raise RangeNotSatisfiableError(range_header)
+    if end <= start:
+        return None
+
+    return start, min(end, size)
@@ -0,0 +1,172 @@
+import hashlib
+import os
+import tempfile
+from io import BytesIO
+from typing import Dict, Tuple
+from PIL import Image
+from Utils.Compression import codec_for_path
+
+
+class InvalidImageError(Exception):
+    pass
+
+
+class ImageConversionError(Exception):
+    pass
+
+
+class UploadTooLargeError(Exception):
+    pass
+
+
+def spool_upload(
+    upload, max_bytes: int, chunk_size: int = 1024 * 1024, directory: str = None
+) -> str:
+    """
+    Copies an upload to a named temporary file, chunk by chunk.
+
+    The web framework keeps a received upload in an anonymous temporary file,
+    the worker pool needs a path it can open. This does blocking I/O, run it
+    off the event loop. The size of the request body is limited before it is
+    received, see Utils.RequestLimits. The caller owns the returned file and
+    must remove it.
+
+    Args:
+        upload: A binary file object (e.g. UploadFile.file).
+        max_bytes: Maximum accepted size of the upload.
+        chunk_size: Size of the chunks copied at a time.
+        directory: Where to create the temporary file, defaults to the system one.
+
+    Returns:
+        The path of the spooled file.
+    """
+    fd, path = tempfile.mkstemp(prefix="upload-", dir=directory)
+    size = 0
+
+    try:
+        with os.fdopen(fd, "wb") as f_out:
+            while chunk := upload.read(chunk_size):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLargeError(
+                        f"upload is larger than {max_bytes} bytes"
+                    )
+                f_out.write(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+
+    return path
+
+
+def downscale(img: Image.Image, size: int) -> Image.Image:
+    # fits the image in a size x size box, never upscales
+    variant = img.copy()
+    variant.thumbnail((size, size), Image.LANCZOS, reducing_gap=2.0)
+    return variant
+
+
+def encode_image(img: Image.Image, image_format: str, **params) -> bytes:
+    content = BytesIO()
+    img.save(content, format=image_format.upper(), **params)
+    return content.getvalue()
+
+
+def process_image(
+    path: str,
+    image_format: str,
+    color_mode: str,
+    save_all: bool = False,
+    max_pixels: int = None,
+    variant_sizes: Tuple[int, ...] = (),
+) -> Tuple[bytes, Dict[int, bytes]]:
+    """
+    Verifies, converts and encodes an uploaded image and its downscaled
+    variants.
+
+    This runs inside the worker pool, so it only takes and returns picklable
+    values. The image is decoded straight from the spooled file, so peak memory
+    is bounded by the decoded frame (``max_pixels`` times the bytes per pixel)
+    plus the encoded output. The variants are made from the same decoded
+    frame, each one from the next larger one.
+
+    Args:
+        path: The spooled upload, see spool_upload.
+        image_format: The Pillow format to encode to (e.g. "WEBP").
+        color_mode: The color mode to convert to when not saving all frames.
+        save_all: Whether to keep every frame of animated images, variants
+            only keep the first one.
+        max_pixels: Reject images with more pixels than this before decoding them.
+        variant_sizes: Maximum width and height of each variant.
+
+    Returns:
+        (encoded image bytes, {size: encoded variant bytes})
+    """
+
+    with open(path, "rb") as f_in:
+        try:
+            with Image.open(f_in) as img:
+                # only the header has been read at this point
+                width, height = img.size
+                if max_pixels is not None and width * height > max_pixels:
+                    raise UploadTooLargeError(
+                        f"image has {width * height} pixels, limit is {max_pixels}"
+                    )
+                img.verify()  # Verify if it's a valid image file
+        except UploadTooLargeError:
+            raise
+        except Image.DecompressionBombError as e:
+            raise UploadTooLargeError(str(e))
+        except Exception as e:
+            raise InvalidImageError(str(e))
+
+        f_in.seek(0)
+
+        try:
+            with Image.open(f_in) as img:
+                if save_all:
+                    converted_content = encode_image(img, image_format, save_all=True)
+                    img.seek(0)
+                    converted = img.convert(color_mode) if variant_sizes else None
+                else:
+                    converted = img.convert(color_mode)
+                    converted_content = encode_image(converted, image_format)
+
+                variants = {}
+                source = converted
+                for size in sorted(variant_sizes, reverse=True):
+                    source = downscale(source, size)
+                    variants[size] = encode_image(source, image_format)
+        except Exception as e:
+            raise ImageConversionError(str(e))
+
+    return converted_content, variants
+
+
+def render_variant(
+    path: str, size: int, image_format: str, color_mode: str
+) -> bytes:
+    """
+    Downscales an already stored image, for variants made on first request.
+
+    Args:
+        path: The stored image, its extension names its codec.
+
+    Returns:
+        The encoded variant bytes.
+    """
+    try:
+        with open(path, "rb") as f_in:
+            data = codec_for_path(path).decompress(f_in.read())
+        with Image.open(BytesIO(data)) as img:
+            return encode_image(downscale(img.convert(color_mode), size), image_format)
+    except Exception as e:
+        raise ImageConversionError(str(e))
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f_in:
+        while chunk := f_in.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
@@ -0,0 +1,121 @@
+import base64
+import hashlib
+import hmac
+import os
+import re
+from Utils.WorkerPool import WorkerPool
+
+SCRYPT_PREFIX = "scrypt"
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+# register_user stored unsalted md5 hex digests before scrypt
+MD5_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+def scrypt_maxmem(n: int, r: int, p: int) -> int:
+    # what scrypt allocates for these parameters, plus some slack
+    return 128 * r * (n + p + 2) + 1024 * 1024
+
+
+def hash_password(password: str, n: int = 2**14, r: int = 8, p: int = 1) -> str:
+    """
+    Hashes a password with scrypt and a random salt.
+
+    Returns:
+        "scrypt$n$r$p$salt$key", salt and key in base64.
+    """
+    salt = os.urandom(SALT_BYTES)
+    key = hashlib.scrypt(
+        password.encode(),
+        salt=salt,
+        n=n,
+        r=r,
+        p=p,
+        maxmem=scrypt_maxmem(n, r, p),
+        dklen=KEY_BYTES,
+    )
+    return f"{SCRYPT_PREFIX}${n}${r}${p}${b64encode(salt)}${b64encode(key)}"
+
+
+def verify_password(password: str, stored: str) -> bool:
+    """
+    Checks a password against a hash made by hash_password or a legacy md5
+    digest, in constant time.
+    """
+    if MD5_PATTERN.match(stored):
+        digest = hashlib.md5(password.encode()).hexdigest()
+        return hmac.compare_digest(digest, stored)
+
+    try:
+        prefix, n, r, p, salt, key = stored.split("$")
+        n, r, p = int(n), int(r), int(p)
+        salt, key = base64.b64decode(salt), base64.b64decode(key)
+    except ValueError:
+        return False
+    if prefix != SCRYPT_PREFIX:
+        return False
+
+    candidate = hashlib.scrypt(
+        password.encode(),
+        salt=salt,
+        n=n,
+        r=r,
+        p=p,
+        maxmem=scrypt_maxmem(n, r, p),
+        dklen=len(key),
+    )
+    return hmac.compare_digest(candidate, key)
+
+
+def needs_rehash(stored: str, n: int, r: int, p: int) -> bool:
+    # md5 digests and hashes made with other cost parameters
+    return not stored.startswith(f"{SCRYPT_PREFIX}${n}${r}${p}$")
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords off the event loop.
+
+    scrypt releases the GIL, so the KDFs run in a thread pool: at most
+    ``max_workers`` hash at once and at most ``max_pending`` run or wait,
+    beyond that WorkerPoolFullError is raised.
+
+    Args:
+        n: scrypt CPU/memory cost, a power of 2.
+        r: scrypt block size.
+        p: scrypt parallelization.
+        max_workers: Number of concurrent KDFs, defaults to the CPU count.
+        max_pending: Maximum number of KDFs running or queued at once.
+    """
+
+    def __init__(
+        self,
+        n: int = 2**14,
+        r: int = 8,
+        p: int = 1,
+        max_workers: int = None,
+        max_pending: int = None,
+    ):
+        self.n = n
+        self.r = r
+        self.p = p
+        self.pool = WorkerPool(
+            kind="thread", max_workers=max_workers, max_pending=max_pending
+        )
+
+    async def hash(self, password: str) -> str:
+        return await self.pool.run(hash_password, password, self.n, self.r, self.p)
+
+    async def verify(self, password: str, stored: str) -> bool:
+        return await self.pool.run(verify_password, password, stored)
+
+    def needs_rehash(self, stored: str) -> bool:
+        return needs_rehash(stored, self.n, self.r, self.p)
+
+    def shutdown(self):
+        self.pool.shutdown()
@@ -0,0 +1,100 @@
+import asyncio
+import os
+import time
+from concurrent.futures import (
+    BrokenExecutor,
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from typing import Callable, Tuple
+
+
+class WorkerPoolFullError(Exception):
+    pass
+
+
+class WorkerPoolBrokenError(WorkerPoolFullError):
+    # a worker died (e.g. killed by the OOM killer), the next job gets a new pool
+    pass
+
+
+def timed(fn, *args) -> Tuple[float, object]:
+    # runs in the worker, so the time excludes queueing and pickling
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+class WorkerPool:
+    """
+    Runs CPU bound jobs off the event loop with a bounded amount of in-flight
+    work, beyond it WorkerPoolFullError is raised.
+
+    Args:
+        kind: "process", "thread" or "inline" (runs on the event loop, for debugging).
+        max_workers: Number of workers, defaults to the CPU count.
+        max_pending: Maximum number of jobs running or queued at once,
+            defaults to twice the number of workers.
+        observe: Called with the name of the function and the seconds it ran
+            for, after every job.
+    """
+
+    def __init__(
+        self,
+        kind: str = "process",
+        max_workers: int = None,
+        max_pending: int = None,
+        observe: Callable[[str, float], None] = None,
+    ):
+        if kind not in ("process", "thread", "inline"):
+            raise ValueError(f"unknown worker pool kind: {kind}")
+
+        self.kind = kind
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.max_workers * 2
+        self.pending = 0
+        self.observe = observe
+        self._executor: Executor = None
+
+    def _get_executor(self) -> Executor:
+        # the executor is created lazily so worker processes are not forked at import
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    async def run(self, fn, *args):
+        # only called from the event loop, so the counter needs no lock
+        if self.pending >= self.max_pending:
+            raise WorkerPoolFullError(f"{self.pending} jobs already in flight")
+        self.pending += 1
+
+        try:
+            if self.kind == "inline":
+                seconds, result = timed(fn, *args)
+            else:
+                executor = self._get_executor()
+                loop = asyncio.get_running_loop()
+                seconds, result = await loop.run_in_executor(
+                    executor, timed, fn, *args
+                )
+        except BrokenExecutor as e:
+            # the other jobs of a broken executor fail too, drop it only once
+            if self._executor is executor:
+                self._executor = None
+                executor.shutdown(wait=False)
+            raise WorkerPoolBrokenError(f"worker pool is broken: {e}") from e
+        finally:
+            self.pending -= 1
+
+        if self.observe is not None:
+            self.observe(fn.__name__, seconds)
+        return result
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
@@ -3,17 +3,57 @@ from fastapi import (
     File,
     UploadFile,
     HTTPException,
+    Request,
+    Depends,
 )
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    PlainTextResponse,
+    StreamingResponse,
+    Response,
+)
+from fastapi.concurrency import run_in_threadpool
+import logging
 import os
 import uuid
-from PIL import Image
+import hashlib
 from os import getenv
 from dotenv import load_dotenv
 from models import Post
-from database.DatabaseManager import DatabaseManager
-from io import BytesIO
-from Utils.Compression import compress_file, decompress_file, is_compressed
+from database.AsyncDatabaseManager import AsyncDatabaseManager, AsyncUnitOfWork
+from database.DatabaseManager import count_rows, record_queries
+from database.Pagination import page_cursors
+from typing import List, Union
+from Utils.Compression import (
+    CODECS,
+    Codec,
+    codec_for_path,
+    compress_if_worth_it,
+    get_codec,
+)
+from Utils.ImageProcessing import (
+    process_image,
+    render_variant,
+    InvalidImageError,
+    ImageConversionError,
+    UploadTooLargeError,
+    spool_upload,
+    hash_file,
+)
+from Utils.WorkerPool import WorkerPool, WorkerPoolFullError
+from Utils.Cache import LRUCache, NullCache
+from Utils.BulkImport import import_posts
+from Utils.Passwords import PasswordHasher
+from Utils.Logging import configure_logging
+from Utils.Metrics import CONTENT_TYPE, MetricsMiddleware, MetricsRegistry
+from Utils.RequestLimits import BodySizeLimitMiddleware
+from Utils.HttpCache import (
+    http_date,
+    is_not_modified,
+    parse_range,
+    RangeNotSatisfiableError,
+)
 from init import (
     required_directories_init,
     check_save_support,
@@ -29,7 +69,7 @@ load_dotenv()
 IMAGE_DIRECTORY = getenv("IMAGES_DIRECTORY", "uploads/images")
 IMAGE_FORMAT = getenv("IMAGE_FORMAT", "webp").upper()
 IMAGE_EXTENSION = getenv("IMAGE_EXTENSION", "webp")
-COMPRESS_IMAGE = getenv("COMPRESS_IMAGE", "true").lower() in [
+TRUTHY_VALUES = [
     "true",
     "1",
     "t",
@@ -40,41 +80,241 @@ COMPRESS_IMAGE = getenv("COMPRESS_IMAGE", "true").lower() in [
     "certainly",
     "uh-huh",
 ]
+COMPRESS_IMAGE = getenv("COMPRESS_IMAGE", "true").lower() in TRUTHY_VALUES
+
+# codec of new files, one of Utils.Compression.CODECS; every file records its
+# codec in its extension, so files stored with another codec stay readable
+IMAGE_CODEC_LEVEL = getenv("IMAGE_CODEC_LEVEL")
+IMAGE_CODEC = get_codec(
+    getenv("IMAGE_CODEC", "gzip").lower() if COMPRESS_IMAGE else "raw",
+    int(IMAGE_CODEC_LEVEL) if IMAGE_CODEC_LEVEL else None,
+)
+# images that shrink less than this fraction are stored raw
+IMAGE_COMPRESSION_MIN_SAVING = float(getenv("IMAGE_COMPRESSION_MIN_SAVING", 0.05))
+# where stored files are looked for, the configured codec first
+STORED_CODECS = [IMAGE_CODEC] + [
+    codec() for name, codec in CODECS.items() if name != IMAGE_CODEC.name
+]
+
+# send stored files untouched with their Content-Encoding (gzip, deflate or
+# zstd) to clients that accept it, instead of decompressing them every time
+SERVE_GZIP_AS_IS = getenv("SERVE_GZIP_AS_IS", "true").lower() in TRUTHY_VALUES
+
+IMAGE_CACHE_CONTROL = getenv(
+    "IMAGE_CACHE_CONTROL", "public, max-age=31536000, immutable"
+)
+
+# in memory cache of served images, 0 disables it
+IMAGE_CACHE_BYTES = int(getenv("IMAGE_CACHE_BYTES", 64 * 1024 * 1024))
+IMAGE_CACHE_MAX_ITEM_BYTES = int(
+    getenv("IMAGE_CACHE_MAX_ITEM_BYTES", 4 * 1024 * 1024)
+)
+IMAGE_CACHE_TTL = float(getenv("IMAGE_CACHE_TTL", 3600))
 
 
 DATABASE_URL = getenv("DATABASE_URL", "sqlite:///./database.db")
 
+
+def optional_int(value: Union[str, None]) -> Union[int, None]:
+    return int(value) if value not in (None, "") else None
+
+
+DATABASE_POOL_SIZE = optional_int(getenv("DATABASE_POOL_SIZE"))
+DATABASE_MAX_OVERFLOW = optional_int(getenv("DATABASE_MAX_OVERFLOW"))
+DATABASE_POOL_RECYCLE = optional_int(getenv("DATABASE_POOL_RECYCLE"))
+DATABASE_POOL_PRE_PING = (
+    getenv("DATABASE_POOL_PRE_PING", "false").lower() in TRUTHY_VALUES
+)
+# scrypt cost of new password hashes, existing ones are rehashed on login
+PASSWORD_SCRYPT_N = int(getenv("PASSWORD_SCRYPT_N", 2**14))
+PASSWORD_SCRYPT_R = int(getenv("PASSWORD_SCRYPT_R", 8))
+PASSWORD_SCRYPT_P = int(getenv("PASSWORD_SCRYPT_P", 1))
+PASSWORD_HASH_WORKERS = int(getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+PASSWORD_HASH_MAX_PENDING = int(
+    getenv("PASSWORD_HASH_MAX_PENDING", PASSWORD_HASH_WORKERS * 4)
+)
+PASSWORD_RETRY_AFTER = int(getenv("PASSWORD_RETRY_AFTER", 1))
+
+# read-through cache of sections and users, in rows, 0 disables it
+DATABASE_CACHE_ROWS = int(getenv("DATABASE_CACHE_ROWS", 10_000))
+DATABASE_CACHE_TTL = float(getenv("DATABASE_CACHE_TTL", 300))
+# only used when DATABASE_URL points to SQLite
+SQLITE_PRAGMAS = {
+    "journal_mode": getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(getenv("SQLITE_BUSY_TIMEOUT", 5000)),
+    "mmap_size": int(getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+}
+
+# "process", "thread" or "inline"
+IMAGE_WORKER_POOL = getenv("IMAGE_WORKER_POOL", "process").lower()
+IMAGE_WORKERS = int(getenv("IMAGE_WORKERS", os.cpu_count() or 1))
+IMAGE_MAX_PENDING_JOBS = int(getenv("IMAGE_MAX_PENDING_JOBS", IMAGE_WORKERS * 2))
+IMAGE_RETRY_AFTER = int(getenv("IMAGE_RETRY_AFTER", 1))
+
+MAX_UPLOAD_BYTES = int(getenv("MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
+# room for the multipart boundaries and part headers around the image
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+MAX_IMAGE_PIXELS = int(getenv("MAX_IMAGE_PIXELS", 50_000_000))
+UPLOAD_CHUNK_SIZE = int(getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+UPLOAD_SPOOL_DIRECTORY = getenv("UPLOAD_SPOOL_DIRECTORY", None)
+
+# "uuid" stores every upload under a fresh uuid, "content" stores images under
+# the hash of their converted bytes and deduplicates identical uploads
+IMAGE_STORAGE_MODE = getenv("IMAGE_STORAGE_MODE", "uuid").lower()
+
+# posts inserted per transaction by /bulk/posts and importer.py
+BULK_IMPORT_BATCH_SIZE = int(getenv("BULK_IMPORT_BATCH_SIZE", 5000))
+MAX_BULK_IMPORT_BYTES = int(getenv("MAX_BULK_IMPORT_BYTES", 100 * 1024 * 1024))
+
+# downscaled variants served by /retrieve/image/{id}?size=, the number is the
+# maximum width and height; "eager" makes them at upload, "lazy" on first request
+IMAGE_VARIANT_SIZES = tuple(
+    int(size) for size in getenv("IMAGE_VARIANT_SIZES", "128,512").split(",") if size
+)
+IMAGE_VARIANT_MODE = getenv("IMAGE_VARIANT_MODE", "eager").lower()
+
+LOG_LEVEL = getenv("LOG_LEVEL", "INFO")
+# "text" or "json", one object per line with the fields passed as extra
+LOG_FORMAT = getenv("LOG_FORMAT", "text").lower()
+
 REQUIRED_DIRECTORIES = [IMAGE_DIRECTORY]
 SAVE_ALL = False
 COLOR_MODE = "RGB"
 
+logger = logging.getLogger(__name__)
+
+metrics = MetricsRegistry(namespace="tito")
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    "http_request_duration_seconds",
+    "Time spent serving HTTP requests, by route template.",
+    ("method", "route", "status"),
+)
+DB_QUERY_SECONDS = metrics.histogram(
+    "db_query_duration_seconds",
+    "Time spent in database queries, by DatabaseManager method.",
+    ("method",),
+)
+IMAGE_JOB_SECONDS = metrics.histogram(
+    "image_job_duration_seconds",
+    "Time spent by image worker jobs (conversion and encoding, variants, hashing).",
+    ("job",),
+)
+IMAGE_COMPRESS_SECONDS = metrics.histogram(
+    "image_compression_duration_seconds",
+    "Time spent compressing stored images, by configured codec.",
+    ("codec",),
+)
+IMAGE_DECOMPRESS_SECONDS = metrics.histogram(
+    "image_decompression_duration_seconds",
+    "Time spent decompressing whole images to serve them, by stored codec.",
+    ("codec",),
+)
+IMAGE_STORED_BYTES = metrics.counter(
+    "image_stored_bytes_total",
+    "Bytes written to the image directory, by codec actually used.",
+    ("codec",),
+)
+
 
 
-db = DatabaseManager(DATABASE_URL)
+db = AsyncDatabaseManager(
+    DATABASE_URL,
+    pool_size=DATABASE_POOL_SIZE,
+    max_overflow=DATABASE_MAX_OVERFLOW,
+    pool_recycle=DATABASE_POOL_RECYCLE,
+    pool_pre_ping=DATABASE_POOL_PRE_PING,
+    sqlite_pragmas=SQLITE_PRAGMAS,
+    cache=(
+        LRUCache(
+            max_bytes=DATABASE_CACHE_ROWS, ttl=DATABASE_CACHE_TTL, sizeof=count_rows
+        )
+        if DATABASE_CACHE_ROWS > 0
+        else NullCache()
+    ),
+)
+record_queries(
+    db.engine.sync_engine,
+    lambda method, seconds: DB_QUERY_SECONDS.observe(seconds, method=method),
+)
+image_pool = WorkerPool(
+    kind=IMAGE_WORKER_POOL,
+    max_workers=IMAGE_WORKERS,
+    max_pending=IMAGE_MAX_PENDING_JOBS,
+    observe=lambda job, seconds: IMAGE_JOB_SECONDS.observe(seconds, job=job),
+)
+password_hasher = PasswordHasher(
+    n=PASSWORD_SCRYPT_N,
+    r=PASSWORD_SCRYPT_R,
+    p=PASSWORD_SCRYPT_P,
+    max_workers=PASSWORD_HASH_WORKERS,
+    max_pending=PASSWORD_HASH_MAX_PENDING,
+)
+image_cache = (
+    LRUCache(max_bytes=IMAGE_CACHE_BYTES, ttl=IMAGE_CACHE_TTL)
+    if IMAGE_CACHE_BYTES > 0
+    else None
+)
 app = FastAPI()
+app.add_middleware(
+    BodySizeLimitMiddleware,
+    limits={"/upload/image": MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES},
+)
+app.add_middleware(MetricsMiddleware, histogram=HTTP_REQUEST_SECONDS)
+
+
+def cache_stat(stat: str):
+    # read from the caches when scraped, hit rate = hits / (hits + misses)
+    def collect():
+        caches = {"database": db.cache, "image": image_cache}
+        return {
+            (name,): cache.stats().get(stat, 0)
+            for name, cache in caches.items()
+            if cache is not None
+        }
+
+    return collect
+
+
+for _stat, _type in (
+    ("hits", "counter"),
+    ("misses", "counter"),
+    ("evictions", "counter"),
+    ("entries", "gauge"),
+):
+    metrics.callback(
+        f"cache_{_stat}_total" if _type == "counter" else f"cache_{_stat}",
+        f"Cache {_stat}, by cache.",
+        ("cache",),
+        _type,
+        cache_stat(_stat),
+    )
 
 
 def initialization():
+    # not at import, importing app must not take over the logging of the caller
+    configure_logging(LOG_LEVEL, LOG_FORMAT)
     required_directories_init(REQUIRED_DIRECTORIES=REQUIRED_DIRECTORIES)
 
     if not check_save_support(IMAGE_FORMAT):
-        print(f"Image extension {IMAGE_FORMAT} does not support saving!")
+        logger.critical("image extension %s does not support saving", IMAGE_FORMAT)
         exit(1)
     else:
-        print(f"Image extension {IMAGE_FORMAT} supports saving!")
+        logger.info("image extension %s supports saving", IMAGE_FORMAT)
 
     global SAVE_ALL
     SAVE_ALL = check_save_all_support(IMAGE_FORMAT)
 
-    if SAVE_ALL:
-        print(f"Image extension {IMAGE_FORMAT} supports saving all frames!")
-    else:
-        print(f"Image extension {IMAGE_FORMAT} does not support saving all frames!")
+    logger.info(
+        "image extension %s %s saving all frames",
+        IMAGE_FORMAT,
+        "supports" if SAVE_ALL else "does not support",
+    )
 
     global COLOR_MODE
     COLOR_MODE = check_color_mode_support(IMAGE_FORMAT)
 
-    print(f"Color mode {COLOR_MODE} is supported by {IMAGE_FORMAT}!")
+    logger.info("color mode %s is supported by %s", COLOR_MODE, IMAGE_FORMAT)
         
     
        
@@ -85,71 +325,214 @@ def initialization():
 
 
 
+@app.on_event("startup")
+async def startup():
+    await db.create_tables()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    image_pool.shutdown()
+    password_hasher.shutdown()
+    await db.close()
+
+
+async def get_db():
+    # one session, and so one pooled connection, for the whole request
+    async with db.unit_of_work() as uow:
+        yield uow
+
+
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
 
 
+def image_path(image_id: str, size: int = None, codec: Codec = IMAGE_CODEC) -> str:
+    name = image_id if size is None else f"{image_id}_{size}"
+    return os.path.join(IMAGE_DIRECTORY, name + "." + IMAGE_EXTENSION + codec.extension)
+
+
+def stored_image_path(image_id: str, size: int = None) -> Union[str, None]:
+    for codec in STORED_CODECS:
+        path = image_path(image_id, size, codec)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def store_image(image_id: str, data: bytes, size: int = None):
+    # already compressed formats are stored raw, see compress_if_worth_it
+    with IMAGE_COMPRESS_SECONDS.time(codec=IMAGE_CODEC.name):
+        codec, data = compress_if_worth_it(
+            data, IMAGE_CODEC, IMAGE_COMPRESSION_MIN_SAVING
+        )
+    IMAGE_STORED_BYTES.inc(len(data), codec=codec.name)
+    path = image_path(image_id, size, codec)
+
+    # write then rename, so concurrent uploads of the same content never
+    # expose a partially written file
+    tmp_path = path + "." + uuid.uuid4().hex + ".tmp"
+    with open(tmp_path, "wb") as f_out:
+        f_out.write(data)
+    os.replace(tmp_path, path)
+
+
 @app.post("/upload/image")
 async def upload_image(image: UploadFile = File(...)):
     # Create the directory if it doesn't exist
     os.makedirs(IMAGE_DIRECTORY, exist_ok=True)
 
-    # Generate a unique UUID for the file
-    file_uuid = str(uuid.uuid4())
-
-    content = await image.read()
-
     try:
-        img = Image.open(BytesIO(content))
-        img.verify()  # Verify if it's a valid image file
+        spooled_path = await run_in_threadpool(
+            spool_upload,
+            image.file,
+            max_bytes=MAX_UPLOAD_BYTES,
+            chunk_size=UPLOAD_CHUNK_SIZE,
+            directory=UPLOAD_SPOOL_DIRECTORY,
+        )
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
 
-    except Exception as e:
-        print(e)
+    try:
+        return {"image_uuid": await save_image_file(spooled_path)}
+    except WorkerPoolFullError as e:
+        logger.warning("upload rejected: %s", e)
+        raise HTTPException(
+            status_code=503,
+            detail="Too many images are being processed, retry later",
+            headers={"Retry-After": str(IMAGE_RETRY_AFTER)},
+        )
+    except InvalidImageError as e:
+        logger.info("invalid image uploaded: %s", e)
         raise HTTPException(
             status_code=400, detail="Uploaded file is not a valid image"
         )
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ImageConversionError as e:
+        logger.warning("uploaded image cannot be converted: %s", e)
+        raise HTTPException(
+            status_code=400,
+            detail=f"Uploaded image cannot be converted in {IMAGE_FORMAT}!",
+        )
+    finally:
+        os.remove(spooled_path)
+
+
+async def save_image_file(path: str) -> str:
+    """
+    Converts and stores an image file.
+
+    Returns:
+        The id of the stored image.
+
+    Raises:
+        WorkerPoolFullError, InvalidImageError, UploadTooLargeError or
+        ImageConversionError, see Utils.WorkerPool and Utils.ImageProcessing.
+    """
+    raw_hash = None
+
+    if IMAGE_STORAGE_MODE == "content":
+        raw_hash = await image_pool.run(hash_file, path)
+        image_id = await db.get_image_by_raw_hash(raw_hash)
+        if image_id is not None:
+            # already stored, skip conversion and compression entirely
+            await db.add_image_reference(image_id)
+            return image_id
+
+    converted_bytes, variants = await image_pool.run(
+        process_image,
+        path,
+        IMAGE_FORMAT,
+        COLOR_MODE,
+        SAVE_ALL,
+        MAX_IMAGE_PIXELS,
+        IMAGE_VARIANT_SIZES if IMAGE_VARIANT_MODE == "eager" else (),
+    )
+
+    if IMAGE_STORAGE_MODE == "content":
+        image_id = hashlib.sha256(converted_bytes).hexdigest()
+        if stored_image_path(image_id) is None:
+            await run_in_threadpool(store_variants, image_id, variants)
+            await run_in_threadpool(store_image, image_id, converted_bytes)
+        await db.add_image_reference(image_id, raw_hash=raw_hash)
+        return image_id
+
+    # Generate a unique UUID for the file
+    file_uuid = str(uuid.uuid4())
+    # compression releases the GIL, keep it off the event loop
+    await run_in_threadpool(store_variants, file_uuid, variants)
+    await run_in_threadpool(store_image, file_uuid, converted_bytes)
 
-    img = Image.open(BytesIO(content))
+    return file_uuid
 
-    final_image_path = os.path.join(IMAGE_DIRECTORY, file_uuid + "." + IMAGE_EXTENSION)
 
-    converted_content = BytesIO()
+def store_variants(image_id: str, variants: dict):
+    # stored before the full image, once it exists its variants do too
+    for size, data in variants.items():
+        store_image(image_id, data, size)
 
+
+async def import_image_file(name: str, path: str) -> str:
+    # per post failures of a bulk import are reported as ValueError
     try:
-        if SAVE_ALL:
-            print("saving all frames...")
-            img.save(converted_content, format=IMAGE_FORMAT.upper(), save_all=True)
-            print("saved!")
-        else:
-            print("saving...")
-            img = img.convert(COLOR_MODE)
-            img.save(converted_content, format=IMAGE_FORMAT.upper())
-            print("saved!")
-    except Exception as e:
-        print(e)
+        return await save_image_file(path)
+    except WorkerPoolFullError:
+        raise ValueError(f"image {name}: too many images are being processed")
+    except InvalidImageError:
+        raise ValueError(f"image {name} is not a valid image")
+    except UploadTooLargeError as e:
+        raise ValueError(f"image {name}: {e}")
+    except ImageConversionError:
+        raise ValueError(f"image {name} cannot be converted in {IMAGE_FORMAT}")
+
+
+@app.delete("/image/{image_uuid}")
+async def delete_image(image_uuid: str):
+    if IMAGE_STORAGE_MODE != "content":
         raise HTTPException(
-            status_code=400,
-            detail=f"Uploaded image cannot be converted in {IMAGE_FORMAT}!",
+            status_code=400, detail="images can only be deleted in content mode"
         )
 
-    converted_bytes = converted_content.getvalue()
+    ref_count = await db.release_image(image_uuid)
+    if ref_count is None:
+        raise HTTPException(status_code=404, detail="uuid not found")
 
-    if COMPRESS_IMAGE:
-        compress_file(converted_bytes, final_image_path + ".gz")
-        img.close()
-    else:
-        with open(final_image_path, "wb") as f_out:
-            f_out.write(converted_bytes)
-        img.close()
-    # Return a response indicating the UUID of the saved image
-    return {"image_uuid": file_uuid}
+    # the file is shared by every upload of the same content, keep it until
+    # the last reference is gone
+    if ref_count <= 0:
+        remove_image_files(image_uuid)
+
+    return {"image_uuid": image_uuid, "ref_count": max(ref_count, 0)}
+
+
+def remove_image_files(image_id: str):
+    # the image and its variants, whatever codec they were stored with
+    for size in (None, *IMAGE_VARIANT_SIZES):
+        for codec in STORED_CODECS:
+            path = image_path(image_id, size, codec)
+            if os.path.exists(path):
+                os.remove(path)
+            if image_cache is not None:
+                image_cache.delete(os.path.basename(path))
+
+
+async def discard_image(image_id: str):
+    """
+    Undoes save_image_file for an image no post ended up using.
+    """
+    if IMAGE_STORAGE_MODE == "content":
+        ref_count = await db.release_image(image_id)
+        if ref_count is None or ref_count > 0:
+            return
+    await run_in_threadpool(remove_image_files, image_id)
 
 
 @app.post("/newPost")
-async def create_thread(post: Post):
+async def create_thread(post: Post, uow: AsyncUnitOfWork = Depends(get_db)):
     # TODO: check for image_uuid existence, section and parent
-    id = db.create_thread(
+    id = await uow.create_thread(
         title=post.title,
         user_id=post.user_id,
         content=post.content,
@@ -160,13 +543,73 @@ async def create_thread(post: Post):
     return {"post_id": id}
 
 
+@app.post("/bulk/posts")
+async def bulk_import_posts(
+    posts: UploadFile = File(...),
+    images: List[UploadFile] = File(None),
+    uow: AsyncUnitOfWork = Depends(get_db),
+):
+    if posts.size is not None and posts.size > MAX_BULK_IMPORT_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Uploaded posts are larger than {MAX_BULK_IMPORT_BYTES} bytes",
+        )
+
+    uploads = {image.filename: image for image in images or []}
+
+    async def store_uploaded_image(name: str) -> str:
+        if name not in uploads:
+            raise ValueError(f"image {name} was not uploaded")
+        try:
+            spooled_path = await run_in_threadpool(
+                spool_upload,
+                uploads[name].file,
+                max_bytes=MAX_UPLOAD_BYTES,
+                chunk_size=UPLOAD_CHUNK_SIZE,
+                directory=UPLOAD_SPOOL_DIRECTORY,
+            )
+        except UploadTooLargeError as e:
+            raise ValueError(f"image {name}: {e}")
+        try:
+            return await import_image_file(name, spooled_path)
+        finally:
+            os.remove(spooled_path)
+
+    lines = (await posts.read()).splitlines()
+    results = await import_posts(
+        uow,
+        lines,
+        batch_size=BULK_IMPORT_BATCH_SIZE,
+        store_image=store_uploaded_image,
+        release_image=discard_image,
+    )
+    failed = sum(1 for result in results if "error" in result)
+
+    return {"imported": len(results) - failed, "failed": failed, "results": results}
+
+
 @app.get("/getThreads")
 async def get_threads_by_section(
-    section_id: int = None, page: int = 0, size: int = 50, ascending: bool = False
+    section_id: int = None,
+    page: int = 0,
+    size: int = 50,
+    ascending: bool = False,
+    cursor: str = None,
+    uow: AsyncUnitOfWork = Depends(get_db),
 ):
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="size must be > 0")
+
+    page_amount = await uow.get_post_max_pages(section_id=section_id, size=size)
+
     try:
-        threads = db.get_threads(
-            section_id=section_id, page=page, size=size, ascending=ascending
+        threads = await uow.get_threads(
+            section_id=section_id,
+            page=page,
+            size=size,
+            ascending=ascending,
+            cursor=cursor,
+            page_amount=page_amount,
         )
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -177,8 +620,12 @@ async def get_threads_by_section(
     t = []
     for thread in threads:
         
-        if thread.user_id:
-            user = db.get_user_by_id(thread.user_id)
+        if thread.username is not None:
+            user = {
+                "id": thread.user_id,
+                "username": thread.username,
+                "email": thread.email,
+            }
         else:
             user = {
                 "username": "Anonymous",
@@ -195,45 +642,70 @@ async def get_threads_by_section(
                 "image_uuid": thread.image_uuid,
                 "section_id": thread.section_id,
                 "parent_id": thread.parent_id,
+                "reply_count": thread.reply_count,
+                "last_reply_at": (
+                    thread.last_reply_at.isoformat()
+                    if thread.last_reply_at is not None
+                    else None
+                ),
+                "bumped_at": thread.bumped_at.isoformat(),
             }
         )
 
     response_obj["threads"] = t
     response_obj["size"] = len(threads)
     response_obj["page"] = page
-    response_obj["page_amount"] = db.get_post_max_pages(
-        section_id=section_id, size=size
-    )
+    response_obj["page_amount"] = page_amount
     response_obj["ascending_order"] = ascending
+    response_obj["next"], response_obj["prev"] = page_cursors(
+        threads, size, cursor=cursor, page=page, key="bumped_at"
+    )
 
-    return response_obj
+    # plain JSON types only, see get_post_by_id
+    return JSONResponse(response_obj)
 
 
 @app.get("/getPost")
-async def get_post_by_id(post_id: int):
-    thread = db.get_thread_by_id(post_id)
-    if not thread:
-        return HTTPException(
-            status_code=400, detail=f"no post fount with id = {post_id}"
+async def get_post_by_id(
+    post_id: int,
+    page: int = 0,
+    size: int = 50,
+    ascending: bool = False,
+    cursor: str = None,
+    uow: AsyncUnitOfWork = Depends(get_db),
+):
+    try:
+        thread, comments = await uow.get_thread_view(
+            post_id, page=page, size=size, ascending=ascending, cursor=cursor
         )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if thread is None:
+        raise HTTPException(
+            status_code=404, detail=f"no post found with id = {post_id}"
+        )
+
     response = {
         "id": thread.id,
         "title": thread.title,
-        "username": thread.username,
+        "username": thread.username or "Anonymous",
         "content": thread.content,
         "image_uuid": thread.image_uuid,
         "section_id": thread.section_id,
         "parent_id": thread.parent_id,
         "is_thread": thread.parent_id is None,
     }
-    comments = db.get_comments_by_thread_id(post_id)
+    response["next"], response["prev"] = page_cursors(
+        comments, size, cursor=cursor, page=page
+    )
     response["comments"] = []
     for comment in comments:
         response["comments"].append(
             {
                 "id": comment.id,
                 "title": comment.title,
-                "username": comment.username,
+                "username": comment.username or "Anonymous",
                 "content": comment.content,
                 "image_uuid": comment.image_uuid,
                 "section_id": comment.section_id,
@@ -241,101 +713,309 @@ async def get_post_by_id(post_id: int):
             }
         )
 
-    return response
+    # only plain JSON types, skip jsonable_encoder which costs more than the
+    # query on long threads
+    return JSONResponse(response)
 
 
 @app.get("/getSections")
-async def get_sections():
-    sections = db.get_all_sections()
+async def get_sections(uow: AsyncUnitOfWork = Depends(get_db)):
+    sections = await uow.get_all_sections()
     sections_resp = []
 
     for section in sections:
         sections_resp.append(
-            {"section_id": section.id, "section_name": section.section_name}
+            {"section_id": section["id"], "section_name": section["section_name"]}
         )
 
     return {"sections": sections_resp}
 
 
 @app.get("/motd")
-async def get_motd():
-    return {"motd": db.get_random_motd().motd}
+async def get_motd(uow: AsyncUnitOfWork = Depends(get_db)):
+    motd = await uow.get_random_motd()
+    return {"motd": motd.motd if motd is not None else None}
 
 
 @app.get("/getSection")
-async def get_section(section_id: int):
-    section = db.get_section_by_id(section_id)
+async def get_section(section_id: int, uow: AsyncUnitOfWork = Depends(get_db)):
+    section = await uow.get_section_by_id(section_id)
+    if section is None:
+        raise HTTPException(
+            status_code=404, detail=f"no section found with id = {section_id}"
+        )
     # return {"section_id": 1, "section_name": "section"}
-    return {"section_id": section.id, "section_name": section.section_name}
+    return {"section_id": section["id"], "section_name": section["section_name"]}
 
 
 @app.get("/popular_threads")
-async def get_popular_threads(size: int = 10):
-    post = db.get_random_post()
-    print(post.__dict__)
-    return [
-        {
-            "thread_id": post.id,
-            "title": post.title,
-            "username": post.username,
-            "content": post.content,
-            "image_uuid": post.image_uuid,
-            "section_id": post.section_id,
-            "parent_id": post.parent_id,
-        }
-    ]
-
-
-@app.get("/retrieve/image/{image_uuid}")
-async def retrieve_image(image_uuid: str):
-    print(image_uuid)
-    if not COMPRESS_IMAGE:
-        if image_uuid.endswith(IMAGE_EXTENSION) and os.path.exists(
-            os.path.join(IMAGE_DIRECTORY, image_uuid)
-        ):
-            return FileResponse(
-                os.path.join(IMAGE_DIRECTORY, image_uuid),
-                media_type="image/" + IMAGE_FORMAT.lower(),
-            )
+async def get_popular_threads(
+    size: int = 10, section_id: int = None, uow: AsyncUnitOfWork = Depends(get_db)
+):
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="size must be > 0")
 
-        path = os.path.join(IMAGE_DIRECTORY, image_uuid + "." + IMAGE_EXTENSION)
-        if not os.path.exists(path):
-            raise HTTPException(status_code=400, detail="uuid not found")
+    threads = await uow.get_popular_threads(size=size, section_id=section_id)
 
-        return FileResponse(path, media_type="image/" + IMAGE_FORMAT.lower())
-    else:
-        if image_uuid.endswith(IMAGE_EXTENSION) and os.path.exists(
-            os.path.join(IMAGE_DIRECTORY, image_uuid + ".gz")
-        ):
-            img_io = BytesIO(
-                decompress_file(
-                    os.path.join(IMAGE_DIRECTORY, image_uuid + ".gz"),
-                    save_decompressed_file=False,
-                )
-            )
-        else:
-            path = os.path.join(
-                IMAGE_DIRECTORY, image_uuid + "." + IMAGE_EXTENSION + ".gz"
+    t = []
+    for thread in threads:
+        t.append(
+            {
+                "thread_id": thread.id,
+                "title": thread.title,
+                "username": thread.user.username if thread.user else "Anonymous",
+                "content": thread.content,
+                "image_uuid": thread.image_uuid,
+                "section_id": thread.section_id,
+                "parent_id": thread.parent_id,
+            }
+        )
+
+    return {"threads": t, "size": len(t)}
+
+
+def find_image_path(image_uuid: str, size: int = None) -> Union[str, None]:
+    # ids can be requested with or without their extension
+    if image_uuid.endswith(IMAGE_EXTENSION):
+        path = stored_image_path(image_uuid.removesuffix("." + IMAGE_EXTENSION), size)
+        if path is not None:
+            return path
+
+    return stored_image_path(image_uuid, size)
+
+
+async def make_variant(image_uuid: str, size: int) -> Union[str, None]:
+    """
+    Makes a missing variant from the stored full image and keeps it on disk.
+
+    Returns:
+        The path of the variant, None if the image does not exist.
+    """
+    path = find_image_path(image_uuid)
+    if path is None:
+        return None
+
+    image_id = os.path.basename(path).removesuffix(codec_for_path(path).extension)
+    image_id = image_id.removesuffix("." + IMAGE_EXTENSION)
+    data = await image_pool.run(render_variant, path, size, IMAGE_FORMAT, COLOR_MODE)
+    # concurrent first requests all render it, the renames are atomic
+    await run_in_threadpool(store_image, image_id, data, size)
+    return stored_image_path(image_id, size)
+
+
+def accepts_encoding(accept_encoding: Union[str, None], content_coding: str) -> bool:
+    if not accept_encoding:
+        return False
+
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() not in (content_coding, "*"):
+            continue
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                return float(q[2:]) > 0
+            except ValueError:
+                return False
+        return True
+
+    return False
+
+
+def read_image_bytes(path: str, codec: Codec = None) -> bytes:
+    with open(path, "rb") as f_in:
+        data = f_in.read()
+    if codec is None:
+        return data
+    with IMAGE_DECOMPRESS_SECONDS.time(codec=codec.name):
+        return codec.decompress(data)
+
+
+@app.api_route("/retrieve/image/{image_uuid}", methods=["GET", "HEAD"])
+async def retrieve_image(image_uuid: str, request: Request, size: int = None):
+    if size is not None and size not in IMAGE_VARIANT_SIZES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"size must be one of {', '.join(map(str, IMAGE_VARIANT_SIZES))}",
+        )
+
+    path = find_image_path(image_uuid, size)
+    if path is None and size is not None:
+        # lazy mode, or an image stored before its variants were configured
+        try:
+            path = await make_variant(image_uuid, size)
+        except WorkerPoolFullError as e:
+            logger.warning("variant rejected: %s", e)
+            raise HTTPException(
+                status_code=503,
+                detail="Too many images are being processed, retry later",
+                headers={"Retry-After": str(IMAGE_RETRY_AFTER)},
             )
+        except ImageConversionError as e:
+            logger.error("variant %s of %s cannot be made: %s", size, image_uuid, e)
+            raise HTTPException(status_code=500, detail="variant cannot be made")
+    if path is None:
+        raise HTTPException(status_code=400, detail="uuid not found")
+
+    media_type = "image/" + IMAGE_FORMAT.lower()
+    codec = codec_for_path(path)
+    send_encoded = (
+        codec.content_coding is not None
+        and SERVE_GZIP_AS_IS
+        and accepts_encoding(
+            request.headers.get("accept-encoding"), codec.content_coding
+        )
+    )
+
+    # stored files never change, so the file name identifies the content; the
+    # encoded body is a different representation and gets its own tag
+    name = os.path.basename(path)
+    if not send_encoded:
+        name = name.removesuffix(codec.extension)
+    etag = f'"{name}"'
+    stat = os.stat(path)
+    last_modified = stat.st_mtime
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(last_modified),
+        "Cache-Control": IMAGE_CACHE_CONTROL,
+    }
+    if codec.content_coding is not None:
+        headers["Vary"] = "Accept-Encoding"
 
-            if not os.path.exists(path):
-                raise HTTPException(status_code=400, detail="uuid not found")
+    if is_not_modified(request.headers, etag, last_modified):
+        return Response(status_code=304, headers=headers)
 
-            img_io = BytesIO(
-                decompress_file(
-                    os.path.join(
-                        IMAGE_DIRECTORY, image_uuid + "." + IMAGE_EXTENSION + ".gz"
-                    ),
-                    save_decompressed_file=False,
-                )
+    if send_encoded:
+        # the stored file already is a valid body in that coding
+        headers["Content-Encoding"] = codec.content_coding
+
+    decompress = codec.name != "raw" and not send_encoded
+    body_size = codec.uncompressed_size(path) if decompress else stat.st_size
+
+    # the cache holds the bytes of the representation, keyed like the ETag
+    data = None
+    cacheable = image_cache is not None and (
+        body_size is None or body_size <= IMAGE_CACHE_MAX_ITEM_BYTES
+    )
+    if cacheable:
+        data = image_cache.get(name)
+    # codecs that do not record the size are inflated whole to learn it
+    if data is None and (cacheable or body_size is None):
+        data = await run_in_threadpool(
+            read_image_bytes, path, codec if decompress else None
+        )
+        if image_cache is not None and len(data) <= IMAGE_CACHE_MAX_ITEM_BYTES:
+            image_cache.set(name, data)
+    if data is not None:
+        body_size = len(data)
+
+    if data is None and not decompress:
+        return FileResponse(path, media_type=media_type, headers=headers)
+
+    headers["Accept-Ranges"] = "bytes"
+
+    start, end = 0, body_size
+    status_code = 200
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header is not None and (
+        if_range is None or if_range in (etag, headers["Last-Modified"])
+    ):
+        try:
+            requested = parse_range(range_header, body_size)
+        except RangeNotSatisfiableError:
+            return Response(
+                status_code=416, headers={"Content-Range": f"bytes */{body_size}"}
             )
+        if requested is not None:
+            start, end = requested
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{body_size}"
+
+    headers["Content-Length"] = str(end - start)
+
+    if request.method == "HEAD":
+        return Response(
+            status_code=status_code, media_type=media_type, headers=headers
+        )
+
+    if data is not None:
+        return Response(
+            content=data if status_code == 200 else data[start:end],
+            status_code=status_code,
+            media_type=media_type,
+            headers=headers,
+        )
+
+    return StreamingResponse(
+        codec.iter_decompress_range(path, start, end),
+        status_code=status_code,
+        media_type=media_type,
+        headers=headers,
+    )
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/stats")
+async def get_stats():
+    return {
+        "image_cache": image_cache.stats() if image_cache is not None else None,
+        "database_cache": db.cache.stats(),
+    }
+
 
-        img_io.seek(0)
-        return StreamingResponse(img_io, media_type="image/" + IMAGE_FORMAT.lower())
-    
 @app.post("/users/register")
-async def register_user(username: str, password: str, email: str):
-    return {"user_id": db.register_user(username, password, email)}
+async def register_user(
+    username: str, password: str, email: str, uow: AsyncUnitOfWork = Depends(get_db)
+):
+    # hashed before touching the database, no connection is held meanwhile
+    try:
+        password_hash = await password_hasher.hash(password)
+    except WorkerPoolFullError as e:
+        logger.warning("registration rejected: %s", e)
+        raise HTTPException(
+            status_code=503,
+            detail="Too many passwords are being hashed, retry later",
+            headers={"Retry-After": str(PASSWORD_RETRY_AFTER)},
+        )
+
+    return {"user_id": await uow.register_user(username, password_hash, email)}
+
+
+@app.post("/users/login")
+async def login_user(username: str, password: str):
+    # db is used directly so that no connection is held during the KDF
+    credentials = await db.get_password_hash(username)
+
+    try:
+        if credentials is None:
+            # same cost as a wrong password, unknown usernames do not answer faster
+            await password_hasher.hash(password)
+            raise HTTPException(status_code=401, detail="invalid credentials")
+
+        user_id, stored = credentials
+        if not await password_hasher.verify(password, stored):
+            raise HTTPException(status_code=401, detail="invalid credentials")
+
+        # legacy md5 rows and older cost parameters are upgraded transparently
+        if password_hasher.needs_rehash(stored):
+            await db.update_password_hash(user_id, await password_hasher.hash(password))
+    except WorkerPoolFullError as e:
+        logger.warning("login rejected: %s", e)
+        raise HTTPException(
+            status_code=503,
+            detail="Too many passwords are being hashed, retry later",
+            headers={"Retry-After": str(PASSWORD_RETRY_AFTER)},
+        )
+
+    return {"user_id": user_id}
     
 
 
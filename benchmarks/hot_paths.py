@@ -0,0 +1,384 @@
+"""
+Measures the hot paths of the server: image uploads and retrieval, thread
+listings and the compression codecs.
+
+Everything runs offline. A scratch SQLite database and image directory are
+seeded with synthetic sections, users, posts and images, then the endpoints
+are called in process through an ASGI client, so neither a server nor the
+network is involved. Settings not overridden here (IMAGE_CODEC,
+IMAGE_CACHE_BYTES, IMAGE_WORKER_POOL...) are read from the environment like
+app.py does, so runs with different settings can be compared.
+
+Results are printed as JSON, or written to ``--output``. The exit status is
+1 when any measured request failed.
+
+Usage:
+    python -m benchmarks.hot_paths [--requests 200] [--concurrency 8]
+        [--posts 20000] [--images 20] [--uploads 20]
+        [--formats PNG,JPEG,GIF] [--seed 0] [--output FILE]
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Awaitable, Callable, Dict, List
+
+import httpx
+from PIL import Image
+
+from Utils.Compression import CODECS, get_codec
+from Utils.Passwords import hash_password
+
+PASSWORD = "correct horse battery staple"
+
+
+def synthetic_image(rng: random.Random, size: int, image_format: str) -> bytes:
+    # gradients plus some noise, compresses like a photo rather than a flat fill
+    noise = Image.frombytes("L", (size, size), rng.randbytes(size * size))
+    img = Image.merge(
+        "RGB",
+        (
+            Image.linear_gradient("L").resize((size, size)),
+            Image.radial_gradient("L").resize((size, size)),
+            noise.point(lambda v: v // 4 + rng.randrange(128)),
+        ),
+    )
+    content = io.BytesIO()
+    img.save(content, image_format)
+    return content.getvalue()
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    # nearest rank
+    if not sorted_values:
+        return 0.0
+    index = round(fraction * len(sorted_values)) - 1
+    return sorted_values[max(0, min(len(sorted_values) - 1, index))]
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / max(len(latencies), 1) * 1000, 3),
+        "requests_per_second": round(len(latencies) / max(elapsed, 1e-9), 2),
+    }
+
+
+async def measure(
+    count: int,
+    concurrency: int,
+    request: Callable[[int], Awaitable[httpx.Response]],
+) -> dict:
+    """
+    Sends ``count`` requests with at most ``concurrency`` in flight.
+
+    Args:
+        request: Sends the i-th request.
+
+    Returns:
+        The latency percentiles and the throughput, see summarize.
+    """
+    latencies = []
+    errors = 0
+    next_index = 0
+
+    async def worker():
+        nonlocal errors, next_index
+        while next_index < count:
+            index = next_index
+            next_index += 1
+            start = time.perf_counter()
+            response = await request(index)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+def measure_codecs(payloads: Dict[str, bytes], seconds: float) -> dict:
+    results = {}
+    for payload_name, data in payloads.items():
+        results[payload_name] = {"bytes": len(data)}
+        for codec_name in CODECS:
+            if codec_name == "raw":
+                continue
+            codec = get_codec(codec_name)
+            compressed = codec.compress(data)
+
+            rates = {}
+            for operation, run in (
+                ("compress", lambda: codec.compress(data)),
+                ("decompress", lambda: codec.decompress(compressed)),
+            ):
+                runs = 0
+                start = time.perf_counter()
+                while time.perf_counter() - start < seconds:
+                    run()
+                    runs += 1
+                elapsed = time.perf_counter() - start
+                # both in uncompressed bytes
+                rates[f"{operation}_bytes_per_second"] = round(
+                    runs * len(data) / elapsed
+                )
+
+            results[payload_name][codec_name] = {
+                "ratio": round(len(compressed) / max(len(data), 1), 4),
+                **rates,
+            }
+    return results
+
+
+async def seed(app, client: httpx.AsyncClient, args, rng: random.Random) -> dict:
+    from Utils.BulkImport import import_posts
+
+    start = time.perf_counter()
+
+    sections = [f"section-{i}" for i in range(4)]
+    for name in sections:
+        await app.db.create_section(name)
+
+    # one KDF for everyone, the benchmark is not about hashing
+    password_hash = hash_password(PASSWORD, app.PASSWORD_SCRYPT_N)
+    user_ids = [
+        await app.db.register_user(f"user-{i}", password_hash, f"{i}@example.com")
+        for i in range(20)
+    ]
+
+    image_uuids = []
+    for i in range(args.images):
+        response = await client.post(
+            "/upload/image",
+            files={"image": (f"{i}.png", synthetic_image(rng, 512, "PNG"))},
+        )
+        response.raise_for_status()
+        image_uuids.append(response.json()["image_uuid"])
+
+    # a tenth threads, the rest replies to random threads
+    lines = []
+    threads = max(args.posts // 10, 1)
+    thread_sections = [rng.randrange(len(sections)) + 1 for _ in range(threads)]
+    words = ("lorem", "ipsum", "dolor", "sit", "amet")
+    for ref in range(args.posts):
+        post = {
+            "ref": ref,
+            "title": f"post {ref}",
+            "content": " ".join(rng.choice(words) for _ in range(30)),
+            "user_id": rng.choice(user_ids + [None]),
+        }
+        if ref < threads:
+            post["section_id"] = thread_sections[ref]
+        else:
+            post["parent_ref"] = rng.randrange(threads)
+            post["section_id"] = thread_sections[post["parent_ref"]]
+        if image_uuids and rng.random() < 0.2:
+            post["image_uuid"] = rng.choice(image_uuids)
+        lines.append(json.dumps(post))
+
+    results = await import_posts(app.db, lines, batch_size=app.BULK_IMPORT_BATCH_SIZE)
+    failed = [result for result in results if "error" in result]
+    if failed:
+        raise RuntimeError(f"seeding failed: {failed[0]}")
+
+    return {
+        "sections": len(sections),
+        "users": len(user_ids),
+        "posts": len(results),
+        "threads": threads,
+        "images": len(image_uuids),
+        "seconds": round(time.perf_counter() - start, 3),
+        "image_uuids": image_uuids,
+        "text": "\n".join(lines).encode(),
+    }
+
+
+async def run(app, args) -> dict:
+    rng = random.Random(args.seed)
+    await app.startup()
+    transport = httpx.ASGITransport(app=app.app)
+    try:
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://benchmark"
+        ) as client:
+            seeded = await seed(app, client, args, rng)
+            image_uuids = seeded.pop("image_uuids")
+            text = seeded.pop("text")
+
+            response = await client.get("/getThreads", params={"section_id": 1})
+            first_page = response.json()
+            # the most recently bumped thread
+            thread_id = first_page["threads"][0]["id"]
+
+            def get(path: str, headers: dict = None, **params):
+                return lambda i: client.get(path, params=params, headers=headers)
+
+            def image(headers: dict = None, **params):
+                return lambda i: client.get(
+                    f"/retrieve/image/{image_uuids[i % len(image_uuids)]}",
+                    params=params,
+                    headers=headers,
+                )
+
+            cases = {
+                "GET /getThreads section": get("/getThreads", section_id=1),
+                "GET /getThreads all sections": get("/getThreads"),
+                "GET /getPost": get("/getPost", post_id=thread_id),
+                "GET /getSections": get("/getSections"),
+                "GET /popular_threads": get("/popular_threads"),
+                "POST /newPost": lambda i: client.post(
+                    "/newPost",
+                    json={"section_id": 1, "title": f"new {i}", "parent_id": thread_id},
+                ),
+            }
+            # the section fits on one page with few --posts
+            if first_page["next"] is not None:
+                cases["GET /getThreads section next page"] = get(
+                    "/getThreads", section_id=1, cursor=first_page["next"]
+                )
+            if image_uuids:
+                identity = {"accept-encoding": "identity"}
+                cases.update(
+                    {
+                        "GET /retrieve/image": image(identity),
+                        "GET /retrieve/image encoded": image(
+                            {"accept-encoding": "gzip, deflate, zstd"}
+                        ),
+                        "GET /retrieve/image range": image(
+                            {**identity, "range": "bytes=1000-4999"}
+                        ),
+                        "GET /retrieve/image variant": image(
+                            identity, size=app.IMAGE_VARIANT_SIZES[0]
+                        ),
+                    }
+                )
+
+            endpoints = {}
+            for name, request in cases.items():
+                # warm up caches and lazy variants, as a running server would be
+                await measure(min(args.concurrency, args.requests), 1, request)
+                endpoints[name] = await measure(
+                    args.requests, args.concurrency, request
+                )
+
+            # more than max_pending uploads at once would measure 503s
+            upload_concurrency = min(args.concurrency, app.image_pool.max_pending)
+            uploads = {}
+            for image_format in args.formats:
+                # distinct content, content mode would skip duplicates
+                bodies = [
+                    synthetic_image(rng, 512, image_format)
+                    for _ in range(args.uploads)
+                ]
+                uploads[image_format] = await measure(
+                    args.uploads,
+                    upload_concurrency,
+                    lambda i: client.post(
+                        "/upload/image",
+                        files={"image": (f"{i}.{image_format.lower()}", bodies[i])},
+                    ),
+                )
+                uploads[image_format]["input_bytes"] = round(
+                    sum(map(len, bodies)) / max(len(bodies), 1)
+                )
+
+            payloads = {"text": text[: 1024 * 1024]}
+            if image_uuids:
+                response = await client.get(
+                    f"/retrieve/image/{image_uuids[0]}",
+                    headers={"accept-encoding": "identity"},
+                )
+                payloads["image"] = response.content
+            compression = measure_codecs(payloads, args.codec_seconds)
+    finally:
+        await app.shutdown()
+
+    return {
+        "config": {
+            "image_format": app.IMAGE_FORMAT,
+            "image_codec": app.IMAGE_CODEC.name,
+            "image_storage_mode": app.IMAGE_STORAGE_MODE,
+            "image_worker_pool": app.IMAGE_WORKER_POOL,
+            "image_cache_bytes": app.IMAGE_CACHE_BYTES,
+            "database_cache_rows": app.DATABASE_CACHE_ROWS,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "upload_concurrency": upload_concurrency,
+            "seed": args.seed,
+        },
+        "seeded": seeded,
+        "endpoints": endpoints,
+        "uploads": uploads,
+        "compression": compression,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hot path benchmarks.")
+    parser.add_argument("--requests", type=int, default=200, help="per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--posts", type=int, default=20_000)
+    parser.add_argument("--images", type=int, default=20, help="seeded images")
+    parser.add_argument("--uploads", type=int, default=20, help="per input format")
+    parser.add_argument(
+        "--formats",
+        type=lambda value: [f.strip().upper() for f in value.split(",") if f.strip()],
+        default=["PNG", "JPEG", "GIF"],
+        help="input formats of the measured uploads",
+    )
+    parser.add_argument(
+        "--codec-seconds", type=float, default=0.5, help="per codec and operation"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="tito-chan-benchmark-")
+    # app.py reads its settings at import time
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(directory, "bench.db")
+    os.environ["IMAGES_DIRECTORY"] = os.path.join(directory, "images")
+    os.environ["UPLOAD_SPOOL_DIRECTORY"] = os.path.join(directory, "spool")
+    try:
+        # the server logs to stderr, stdout is left to the JSON
+        import app
+
+        app.initialization()
+        os.makedirs(os.environ["UPLOAD_SPOOL_DIRECTORY"], exist_ok=True)
+        results = asyncio.run(run(app, args))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, "w") as f_out:
+            f_out.write(output + "\n")
+    else:
+        print(output)
+
+    # the latencies of failed requests are not comparable with the others
+    failed = [
+        name
+        for group in ("endpoints", "uploads")
+        for name, result in results[group].items()
+        if result["errors"]
+    ]
+    if failed:
+        print(f"requests failed in: {', '.join(failed)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""
+Measures the throughput of the password KDF with the configured cost.
+
+Hashes are run on one thread, then on ``--workers`` threads at once through
+PasswordHasher, and reported per second and per second per core.
+
+Usage:
+    python -m benchmarks.password_hashing [--seconds 5] [--workers N]
+        [--n 16384] [--r 8] [--p 1]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from os import getenv
+
+from Utils.Passwords import PasswordHasher, hash_password
+
+
+def measure_single(seconds: float, n: int, r: int, p: int) -> float:
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        hash_password("correct horse battery staple", n, r, p)
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+async def measure_pool(seconds: float, hasher: PasswordHasher, workers: int) -> float:
+    count = 0
+    start = time.perf_counter()
+
+    async def worker():
+        nonlocal count
+        while time.perf_counter() - start < seconds:
+            await hasher.hash("correct horse battery staple")
+            count += 1
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Password hashing throughput.")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    # same defaults and variables as app.py
+    parser.add_argument("--n", type=int, default=getenv("PASSWORD_SCRYPT_N", 2**14))
+    parser.add_argument("--r", type=int, default=getenv("PASSWORD_SCRYPT_R", 8))
+    parser.add_argument("--p", type=int, default=getenv("PASSWORD_SCRYPT_P", 1))
+    args = parser.parse_args()
+
+    hasher = PasswordHasher(n=args.n, r=args.r, p=args.p, max_workers=args.workers)
+    try:
+        single = measure_single(args.seconds, args.n, args.r, args.p)
+        pooled = asyncio.run(measure_pool(args.seconds, hasher, args.workers))
+    finally:
+        hasher.shutdown()
+
+    cores = min(args.workers, os.cpu_count() or 1)
+    print(
+        json.dumps(
+            {
+                "n": args.n,
+                "r": args.r,
+                "p": args.p,
+                "workers": args.workers,
+                "cores": cores,
+                "single_thread_hashes_per_second": round(single, 2),
+                "pool_hashes_per_second": round(pooled, 2),
+                "pool_hashes_per_second_per_core": round(pooled / cores, 2),
+                "milliseconds_per_hash": round(1000 / single, 2),
+            },
+            indent=4,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Union
+from sqlalchemy.engine.url import URL, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from Utils.Cache import CacheBackend
+from .DatabaseManager import (
+    DatabaseManager,
+    DEFAULT_SQLITE_PRAGMAS,
+    SESSION_METHODS,
+    engine_options,
+    set_sqlite_pragmas,
+    traced,
+)
+
+# async drivers used when the url names a synchronous one
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
+
+
+def to_async_url(db_uri: Union[str, URL]) -> URL:
+    url = make_url(db_uri)
+    if url.get_dialect().is_async:
+        return url
+
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"no async driver known for {backend}")
+
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+class AsyncUnitOfWork:
+    """
+    Awaitable counterpart of UnitOfWork: every method runs on the same
+    AsyncSession, so a request checks out a single connection.
+
+    Get one from AsyncDatabaseManager.unit_of_work().
+    """
+
+    def __init__(self, manager: "AsyncDatabaseManager", session: AsyncSession):
+        self.manager = manager
+        self.session = session
+
+    def __getattr__(self, name: str):
+        if name not in SESSION_METHODS:
+            raise AttributeError(name)
+
+        auto_commit = SESSION_METHODS[name].get("auto_commit", False)
+        impl = traced(name, getattr(self.manager, "_" + name), flush=auto_commit)
+
+        async def method(*args, **kwargs):
+            result = await self.session.run_sync(
+                lambda sync_session: impl(*args, session=sync_session, **kwargs)
+            )
+            if auto_commit:
+                await self.session.commit()
+            return result
+
+        # bind it once, later lookups do not go through __getattr__
+        setattr(self, name, method)
+        return method
+
+
+def _in_unit_of_work(name: str):
+    async def method(self, *args, **kwargs):
+        async with self.unit_of_work() as uow:
+            return await getattr(uow, name)(*args, **kwargs)
+
+    method.__name__ = name
+    method.__qualname__ = "AsyncDatabaseManager." + name
+    return method
+
+
+class AsyncDatabaseManager(DatabaseManager):
+    """
+    DatabaseManager on SQLAlchemy's asyncio engine.
+
+    It exposes the same methods as coroutines. They run the DatabaseManager
+    queries through AsyncSession.run_sync, so every round trip goes through the
+    async driver (aiosqlite, asyncpg...) and never blocks the event loop.
+    Calls made on the manager each use their own session, use unit_of_work()
+    to share one between several calls.
+
+    ``await create_tables()`` has to be called once before using it.
+    """
+
+    def __init__(
+        self,
+        db_uri: Union[str, URL] = "sqlite:///:memory:",
+        pool_size: int = None,
+        max_overflow: int = None,
+        pool_recycle: int = None,
+        pool_pre_ping: bool = False,
+        sqlite_pragmas: dict = DEFAULT_SQLITE_PRAGMAS,
+        cache: CacheBackend = None,
+    ):
+        self._init_state(cache)
+
+        self.engine = create_async_engine(
+            to_async_url(db_uri),
+            **engine_options(pool_size, max_overflow, pool_recycle, pool_pre_ping),
+        )
+        set_sqlite_pragmas(self.engine.sync_engine, sqlite_pragmas)
+        self.session_maker = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    async def create_tables(self):
+        async with self.engine.begin() as connection:
+            await connection.run_sync(self._create_tables)
+
+    @asynccontextmanager
+    async def unit_of_work(self) -> AsyncIterator[AsyncUnitOfWork]:
+        async with self.session_maker() as session:
+            try:
+                yield AsyncUnitOfWork(self, session)
+            except BaseException:
+                await session.rollback()
+                raise
+
+    async def close(self):
+        await self.engine.dispose()
+
+
+# calls made directly on the manager get a unit of work of their own
+for _name in SESSION_METHODS:
+    setattr(AsyncDatabaseManager, _name, _in_unit_of_work(_name))
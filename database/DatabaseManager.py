@@ -1,16 +1,287 @@
-from sqlalchemy import create_engine, func, inspect
+from sqlalchemy import (
+    bindparam,
+    case,
+    create_engine,
+    event,
+    func,
+    insert,
+    inspect,
+    null,
+    select,
+    union_all,
+    update,
+)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from .migrations.migration import Base, Posts, Sections, Motds, Users
-from typing import Union
+from sqlalchemy.orm import sessionmaker, joinedload, aliased, close_all_sessions
+from .migrations.migration import (
+    Posts,
+    Sections,
+    Motds,
+    Users,
+    Images,
+    ImageSources,
+    SectionStats,
+    ThreadStats,
+    ThreadScores,
+    ThreadSummaries,
+    upgrade,
+    utcnow,
+)
+from typing import Callable, Iterator, List, Tuple, Union
+from contextlib import contextmanager
+from contextvars import ContextVar
+import logging
+import math
+import time
+from datetime import datetime, timezone
+from sqlalchemy.engine import Connection, Engine, Row
 from sqlalchemy.engine.url import URL
+from sqlalchemy.exc import IntegrityError
 from functools import wraps
 from sessionmanager.SessionManager import SessionManager
 from sqlalchemy.orm.session import Session
+from .Pagination import keyset_condition, keyset_paginate, listing_order
+from Utils.Cache import CacheBackend, LRUCache
+
+logger = logging.getLogger(__name__)
+
+Replies = aliased(Posts)
+
+# reference time of the hot scores, only keeps the stored numbers small
+HOT_EPOCH = 1_700_000_000
+
+
+def logaddexp(a: float, b: float) -> float:
+    return max(a, b) + math.log1p(math.exp(-abs(a - b)))
+
+
+def timestamp_of(date: datetime) -> float:
+    # dates are stored by CURRENT_TIMESTAMP, which is UTC
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+# WAL lets readers run while /newPost writes, NORMAL is durable enough in WAL
+# mode and busy_timeout makes writers wait for the lock instead of failing
+DEFAULT_SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+}
+
+
+def engine_options(
+    pool_size: int = None,
+    max_overflow: int = None,
+    pool_recycle: int = None,
+    pool_pre_ping: bool = False,
+) -> dict:
+    # only pass what was configured, some pools (e.g. sqlite :memory:) reject sizes
+    options = {"pool_pre_ping": pool_pre_ping}
+    if pool_size is not None:
+        options["pool_size"] = pool_size
+    if max_overflow is not None:
+        options["max_overflow"] = max_overflow
+    if pool_recycle is not None:
+        options["pool_recycle"] = pool_recycle
+    return options
+
+
+def set_sqlite_pragmas(engine: Engine, pragmas: dict):
+    """
+    Runs the given PRAGMAs on every new connection of a SQLite engine.
+    Engines of other databases are left untouched.
+    """
+    if engine.dialect.name != "sqlite" or not pragmas:
+        return
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+# name of the DatabaseManager method whose queries are running, see traced
+current_method: ContextVar[Union[str, None]] = ContextVar(
+    "current_method", default=None
+)
+
+# connection.info key of the start times of the running queries
+QUERY_STARTS = "query_starts"
+
+
+def traced(name: str, impl, flush: bool = False):
+    # queries run by impl are attributed to name by record_queries, with flush
+    # the pending writes of its session too, they would run later at commit
+    @wraps(impl)
+    def method(*args, **kwargs):
+        token = current_method.set(name)
+        try:
+            result = impl(*args, **kwargs)
+            if flush and kwargs.get("session") is not None:
+                kwargs["session"].flush()
+            return result
+        finally:
+            current_method.reset(token)
+
+    return method
+
+
+def record_queries(engine: Engine, observe: Callable[[str, float], None]):
+    """
+    Calls ``observe(method, seconds)`` after every query of an engine, with the
+    DatabaseManager method that ran it ("other" outside of them).
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _start(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault(QUERY_STARTS, []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _end(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info[QUERY_STARTS].pop()
+        observe(current_method.get() or "other", time.perf_counter() - start)
+
+    @event.listens_for(engine, "handle_error")
+    def _failed(context):
+        if context.connection is not None and context.connection.info.get(
+            QUERY_STARTS
+        ):
+            context.connection.info[QUERY_STARTS].pop()
+
+
+# public methods of DatabaseManager and the SessionManager options they run
+# with, each one is implemented by the method of the same name prefixed by "_"
+SESSION_METHODS = {
+    "create_thread": {"auto_commit": True},
+    "import_posts": {"auto_commit": True},
+    "get_threads": {"raise_error_types": (ValueError)},
+    "get_post_max_pages": {},
+    "get_thread_by_id": {},
+    "delete_thread_by_id": {"auto_commit": True},
+    "update_thread_by_id": {"auto_commit": True},
+    "get_comments_by_thread_id": {"raise_error_types": (ValueError)},
+    "get_thread_view": {"raise_error_types": (ValueError)},
+    "create_section": {"auto_commit": True},
+    "get_all_sections": {},
+    "get_random_motd": {},
+    "create_motd": {"auto_commit": True},
+    "get_random_post": {},
+    "get_popular_threads": {},
+    "get_section_by_id": {},
+    "register_user": {"auto_commit": True},
+    "get_user_by_username": {},
+    "get_user_by_id": {},
+    "get_password_hash": {},
+    "update_password_hash": {"auto_commit": True},
+    "check_user_existence": {},
+    "get_image_by_raw_hash": {},
+    "add_image_reference": {"auto_commit": True},
+    "release_image": {"auto_commit": True},
+}
+
+
+# bound parameters per IN (...), SQLite used to accept at most 999
+IN_CHUNK_SIZE = 500
+
+
+def rows_in(
+    session: Session, key_column, keys: list, *columns, for_update: bool = False
+) -> list:
+    """
+    Selects the rows whose ``key_column`` is one of ``keys``, in chunks of
+    IN_CHUNK_SIZE keys.
+
+    Returns:
+        The keys found, or (key, *columns) rows when columns are given.
+    """
+    keys = list(dict.fromkeys(k for k in keys if k is not None))
+    rows = []
+    for start in range(0, len(keys), IN_CHUNK_SIZE):
+        query = session.query(key_column, *columns).filter(
+            key_column.in_(keys[start : start + IN_CHUNK_SIZE])
+        )
+        if for_update:
+            query = query.with_for_update()
+        rows.extend(query.all() if columns else (row[0] for row in query))
+    return rows
+
+
+class UnitOfWork:
+    """
+    Runs DatabaseManager methods on one shared session, e.g. for a whole
+    request, instead of opening a session per call.
+
+    Get one from DatabaseManager.unit_of_work().
+    """
+
+    def __init__(self, manager: "DatabaseManager", session: Session):
+        self.manager = manager
+        self.session = session
+
+    def __getattr__(self, name: str):
+        if name not in SESSION_METHODS:
+            raise AttributeError(name)
+
+        auto_commit = SESSION_METHODS[name].get("auto_commit", False)
+        impl = traced(name, getattr(self.manager, "_" + name), flush=auto_commit)
+
+        def method(*args, **kwargs):
+            result = impl(*args, session=self.session, **kwargs)
+            if auto_commit:
+                self.session.commit()
+            return result
+
+        # bind it once, later lookups do not go through __getattr__
+        setattr(self, name, method)
+        return method
+
+
+# session.info key of the cache entries to drop once the session commits
+INVALIDATE_AFTER_COMMIT = "invalidate_after_commit"
+DEFAULT_CACHE_ROWS = 10_000
+DEFAULT_CACHE_TTL = 300
+
+_MISSING = object()
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session: Session):
+    for cache, key in session.info.pop(INVALIDATE_AFTER_COMMIT, ()):
+        cache.delete(key)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_invalidations(session: Session):
+    session.info.pop(INVALIDATE_AFTER_COMMIT, None)
+
+
+def count_rows(value) -> int:
+    # size of a cached value for LRUCache, the budget is in rows
+    return len(value) if isinstance(value, list) else 1
+
 
 class DatabaseManager:
-    def __init__(self, db_uri: Union[str, URL] = "sqlite:///:memory:"):
-        self.engine = create_engine(db_uri)
+    def __init__(
+        self,
+        db_uri: Union[str, URL] = "sqlite:///:memory:",
+        pool_size: int = None,
+        max_overflow: int = None,
+        pool_recycle: int = None,
+        pool_pre_ping: bool = False,
+        sqlite_pragmas: dict = DEFAULT_SQLITE_PRAGMAS,
+        cache: CacheBackend = None,
+    ):
+        self._init_state(cache)
+
+        self.engine = create_engine(
+            db_uri,
+            **engine_options(pool_size, max_overflow, pool_recycle, pool_pre_ping),
+        )
+        set_sqlite_pragmas(self.engine, sqlite_pragmas)
         self.Base = declarative_base()
         self.session_maker = sessionmaker(bind=self.engine)
         self.create_tables()
@@ -18,283 +289,1109 @@ class DatabaseManager:
         self.SM = SessionManager()
         self.SM.set_session_maker(self.session_maker)
 
+        # the session managed wrappers are built once, not on every access
+        for name, options in SESSION_METHODS.items():
+            impl = traced(
+                name,
+                getattr(self, "_" + name),
+                flush=options.get("auto_commit", False),
+            )
+            setattr(self, name, self.SM.session_management(**options)(impl))
+
+    def _init_state(self, cache: CacheBackend = None):
+        self.motd_refresh_seconds = 300
+        # a reply counts half as much after this many seconds
+        self.hot_half_life = 6 * 60 * 60
+        self._motds = None
+        self._motds_expire_at = 0
+
+        # sections and users, read through by the get methods
+        self.cache = (
+            cache
+            if cache is not None
+            else LRUCache(
+                max_bytes=DEFAULT_CACHE_ROWS, ttl=DEFAULT_CACHE_TTL, sizeof=count_rows
+            )
+        )
+
+    def _cached(self, key: str, load):
+        value = self.cache.get(key, _MISSING)
+        if value is _MISSING:
+            value = load()
+            # misses are not cached, rows created later show up right away
+            if value is not None:
+                self.cache.set(key, value)
+        return value
+
+    def _invalidate(self, session: Session, *keys: str):
+        # dropped now and again after the commit, so a read made in between
+        # cannot keep the old value cached until the TTL
+        for key in keys:
+            self.cache.delete(key)
+        session.info.setdefault(INVALIDATE_AFTER_COMMIT, []).extend(
+            (self.cache, key) for key in keys
+        )
+
+    @contextmanager
+    def unit_of_work(self) -> Iterator[UnitOfWork]:
+        with self.session_maker(expire_on_commit=False) as session:
+            try:
+                yield UnitOfWork(self, session)
+            except BaseException:
+                session.rollback()
+                raise
 
     def create_tables(self):
-        Base.metadata.create_all(self.engine)
-
-
-    @property
-    def create_thread(self):
-        @self.SM.session_management(auto_commit=True)
-        def _create_thread(
-            user_id: int,
-            section_id: int,
-            title: str,
-            content: str = None,
-            image_uuid: str = None,
-            parent_id: int = None,
-            session=None,
-        ) -> int:
-            
-            
-            # TODO: check for image_uuid existence, section and parent
-
-            post = Posts(
-                title=title,
-                user_id=user_id,
-                content=content,
-                image_uuid=image_uuid,
-                section_id=section_id,
-                parent_id=parent_id,
+        with self.engine.begin() as connection:
+            self._create_tables(connection)
+
+    def _create_tables(self, connection: Connection):
+        inspector = inspect(connection)
+        new_counters = not inspector.has_table(
+            SectionStats.__tablename__
+        ) or not inspector.has_table(ThreadStats.__tablename__)
+        new_scores = not inspector.has_table(ThreadScores.__tablename__)
+        new_summaries = not inspector.has_table(ThreadSummaries.__tablename__)
+
+        upgrade(connection)
+
+        # databases created before these tables existed need them filled once
+        if new_counters or new_scores or new_summaries:
+            with Session(bind=connection) as session:
+                if new_counters:
+                    self._rebuild_counters(session)
+                if new_scores:
+                    self._rebuild_scores(session)
+                if new_summaries:
+                    self._rebuild_summaries(session)
+                session.flush()
+
+    def _rebuild_counters(self, session: Session):
+        session.query(SectionStats).delete()
+        session.query(ThreadStats).delete()
+
+        threads = (
+            session.query(Posts.section_id, func.count(Posts.id))
+            .filter(Posts.parent_id == None)  # noqa: E711
+            .group_by(Posts.section_id)
+        )
+        for section_id, thread_count in threads:
+            session.add(SectionStats(section_id=section_id, thread_count=thread_count))
+
+        replies = (
+            session.query(Posts.id, func.count(Replies.id))
+            .outerjoin(Replies, Replies.parent_id == Posts.id)
+            .filter(Posts.parent_id == None)  # noqa: E711
+            .group_by(Posts.id)
+        )
+        for thread_id, reply_count in replies:
+            session.add(ThreadStats(thread_id=thread_id, reply_count=reply_count))
+
+    def _rebuild_summaries(self, session: Session):
+        session.query(ThreadSummaries).delete()
+
+        replies = (
+            select(
+                Replies.parent_id,
+                func.count(Replies.id).label("reply_count"),
+                func.max(Replies.date).label("last_reply_at"),
             )
-            session.add(post)
-            session.commit()
+            .group_by(Replies.parent_id)
+            .subquery()
+        )
+        threads = (
+            session.query(
+                Posts.id,
+                Posts.section_id,
+                Posts.date,
+                Users.username,
+                replies.c.reply_count,
+                replies.c.last_reply_at,
+            )
+            .outerjoin(Users, Users.id == Posts.user_id)
+            .outerjoin(replies, replies.c.parent_id == Posts.id)
+            .filter(Posts.parent_id == None)  # noqa: E711
+        )
+        summaries = [
+            {
+                "thread_id": thread.id,
+                "section_id": thread.section_id,
+                "reply_count": thread.reply_count or 0,
+                "last_reply_at": thread.last_reply_at,
+                "bumped_at": max(thread.date, thread.last_reply_at or thread.date),
+                "author_name": thread.username,
+            }
+            for thread in threads
+        ]
+        if summaries:
+            session.execute(insert(ThreadSummaries.__table__), summaries)
+
+    @staticmethod
+    def _bump_summaries(session: Session, replies: dict):
+        """
+        Counts new direct replies in the thread summaries, one executemany
+        UPDATE. Ids that are not threads match no summary and are ignored.
+
+        Args:
+            replies: thread id -> (number of new replies, date of the latest)
+        """
+        if not replies:
+            return
+
+        table = ThreadSummaries.__table__
+        date = bindparam("b_date")
+
+        # imports can carry older dates, a summary never moves backwards
+        def latest(column):
+            return case((column > date, column), else_=date)
+
+        session.execute(
+            update(table)
+            .where(table.c.thread_id == bindparam("b_thread_id"))
+            .values(
+                reply_count=table.c.reply_count + bindparam("b_count"),
+                last_reply_at=latest(table.c.last_reply_at),
+                bumped_at=latest(table.c.bumped_at),
+            ),
+            [
+                {"b_thread_id": thread_id, "b_count": count, "b_date": last}
+                for thread_id, (count, last) in replies.items()
+            ],
+        )
 
-            return post.id
+    @staticmethod
+    def _unbump_summary(session: Session, thread_id: int, reply_id: int):
+        # the last reply without the deleted one, read backwards on the
+        # (parent_id, date, id) index
+        last_reply_at = (
+            session.query(Posts.date)
+            .filter(Posts.parent_id == thread_id, Posts.id != reply_id)
+            .order_by(Posts.date.desc(), Posts.id.desc())
+            .limit(1)
+            .scalar()
+        )
+        thread_date = select(Posts.date).where(Posts.id == thread_id).scalar_subquery()
+        session.query(ThreadSummaries).filter(
+            ThreadSummaries.thread_id == thread_id
+        ).update(
+            {
+                ThreadSummaries.reply_count: ThreadSummaries.reply_count - 1,
+                ThreadSummaries.last_reply_at: last_reply_at,
+                ThreadSummaries.bumped_at: (
+                    last_reply_at if last_reply_at is not None else thread_date
+                ),
+            },
+            synchronize_session=False,
+        )
+
+    def hot_term(self, timestamp: float) -> float:
+        """
+        Log of the weight of one post made at ``timestamp``.
+
+        A thread score is the log of the sum of exp(hot_term) over the thread
+        and its replies. All weights decay by the same factor over time, so
+        ordering by the stored score is the same as ordering by the decayed
+        activity at any later moment, and a reply only needs a logaddexp.
+        """
+        return (timestamp - HOT_EPOCH) * math.log(2) / self.hot_half_life
+
+    def _rebuild_scores(self, session: Session):
+        session.query(ThreadScores).delete()
+
+        scores = {}
+        sections = {}
+        for post_id, parent_id, section_id, date in session.query(
+            Posts.id, Posts.parent_id, Posts.section_id, Posts.date
+        ).order_by(Posts.parent_id.is_not(None)):
+            term = self.hot_term(timestamp_of(date))
+            if parent_id is None:
+                scores[post_id] = term
+                sections[post_id] = section_id
+            elif parent_id in scores:
+                scores[parent_id] = logaddexp(scores[parent_id], term)
+
+        for thread_id, score in scores.items():
+            session.add(
+                ThreadScores(
+                    thread_id=thread_id, section_id=sections[thread_id], score=score
+                )
+            )
+
+    def _bump_score(
+        self, session: Session, thread_id: int, term: float, add: bool = True
+    ):
+        thread_score = (
+            session.query(ThreadScores)
+            .filter(ThreadScores.thread_id == thread_id)
+            .with_for_update()
+            .first()
+        )
+        if thread_score is None:
+            return
+
+        if add:
+            thread_score.score = logaddexp(thread_score.score, term)
+        elif term < thread_score.score:
+            # log(exp(score) - exp(term))
+            thread_score.score += math.log1p(-math.exp(term - thread_score.score))
+
+    def _bump_scores(self, session: Session, terms: dict):
+        # _bump_score for many threads, one executemany UPDATE
+        scores = rows_in(
+            session,
+            ThreadScores.thread_id,
+            list(terms),
+            ThreadScores.score,
+            for_update=True,
+        )
+        table = ThreadScores.__table__
+        if scores:
+            session.execute(
+                update(table)
+                .where(table.c.thread_id == bindparam("b_thread_id"))
+                .values(score=bindparam("b_score")),
+                [
+                    {
+                        "b_thread_id": thread_id,
+                        "b_score": logaddexp(score, terms[thread_id]),
+                    }
+                    for thread_id, score in scores
+                ],
+            )
+
+    @staticmethod
+    def _insert_if_missing(session: Session, model, values: dict) -> bool:
+        """
+        Inserts a row unless its primary key is taken, also when a concurrent
+        transaction inserted it after this one looked.
+
+        Returns:
+            Whether the row was inserted.
+        """
+        try:
+            with session.begin_nested():
+                session.execute(insert(model.__table__).values(values))
+        except IntegrityError:
+            return False
+        return True
+
+    @staticmethod
+    def _add_to_counters(session: Session, model, key_column, counter, deltas: dict):
+        # _add_to_counter for many keys, one executemany UPDATE for the rows
+        # which exist and one INSERT for the others
+        existing = set(rows_in(session, key_column, list(deltas)))
+        table = model.__table__
+        key, column = table.c[key_column.key], table.c[counter.key]
+
+        updates = [
+            {"b_key": k, "b_delta": delta}
+            for k, delta in deltas.items()
+            if k in existing
+        ]
+        if updates:
+            session.execute(
+                update(table)
+                .where(key == bindparam("b_key"))
+                .values({column: column + bindparam("b_delta")}),
+                updates,
+            )
+
+        inserts = [
+            {key.key: k, column.key: max(delta, 0)}
+            for k, delta in deltas.items()
+            if k not in existing
+        ]
+        if inserts:
+            try:
+                with session.begin_nested():
+                    session.execute(insert(table), inserts)
+            except IntegrityError:
+                # a concurrent transaction inserted some of them first
+                for row in inserts:
+                    DatabaseManager._add_to_counter(
+                        session,
+                        model,
+                        key_column,
+                        row[key.key],
+                        counter,
+                        deltas[row[key.key]],
+                    )
+
+    @staticmethod
+    def _add_to_counter(
+        session: Session, model, key_column, key, counter, delta: int
+    ):
+        # a single UPDATE keeps concurrent increments from overwriting each other
+        rows = session.query(model).filter(key_column == key)
+        increment = {counter: counter + delta}
+        if not rows.update(increment, synchronize_session=False):
+            inserted = DatabaseManager._insert_if_missing(
+                session, model, {key_column.key: key, counter.key: max(delta, 0)}
+            )
+            # a concurrent transaction inserted it first, see _add_image_reference
+            if not inserted:
+                rows.update(increment, synchronize_session=False)
+
+    def _create_thread(
+        self,
+        user_id: int,
+        section_id: int,
+        title: str,
+        content: str = None,
+        image_uuid: str = None,
+        parent_id: int = None,
+        session=None,
+    ) -> int:
         
-        return _create_thread
-
-    @property
-    def get_threads(self):
-        @self.SM.session_management(raise_error_types=(ValueError))
-        def _get_threads(
-            section_id: int = None,
-            page: int = 0,
-            size: int = 50,
-            ascending: bool = False,
-            session: Session=None,
-        ):
-            if size <= 0:
-                raise ValueError("size must be > 0")
-
-            if page < 0 or page >= self.get_post_max_pages(
-                section_id=section_id, size=size
-            ):
-                raise ValueError(
-                    f"Page must be >= 0 and < {self.get_post_max_pages(section_id=section_id, size=size)}"
+        
+        # TODO: check for image_uuid existence, section and parent
+
+        # set here rather than by the database, the summaries need it too
+        now = utcnow()
+        post = Posts(
+            title=title,
+            user_id=user_id,
+            content=content,
+            image_uuid=image_uuid,
+            section_id=section_id,
+            parent_id=parent_id,
+            date=now,
+        )
+        session.add(post)
+        session.flush()
+
+        # counters are updated in the same transaction as the post
+        if parent_id is None:
+            self._add_to_counter(
+                session,
+                SectionStats,
+                SectionStats.section_id,
+                section_id,
+                SectionStats.thread_count,
+                1,
+            )
+            session.add(ThreadStats(thread_id=post.id, reply_count=0))
+            author = (
+                self._get_user_by_id(user_id, session=session)
+                if user_id is not None
+                else None
+            )
+            session.add(
+                ThreadSummaries(
+                    thread_id=post.id,
+                    section_id=section_id,
+                    reply_count=0,
+                    bumped_at=now,
+                    author_name=author["username"] if author is not None else None,
                 )
+            )
+            session.add(
+                ThreadScores(
+                    thread_id=post.id,
+                    section_id=section_id,
+                    score=self.hot_term(time.time()),
+                )
+            )
+        else:
+            self._add_to_counter(
+                session,
+                ThreadStats,
+                ThreadStats.thread_id,
+                parent_id,
+                ThreadStats.reply_count,
+                1,
+            )
+            self._bump_score(session, parent_id, self.hot_term(time.time()))
+            self._bump_summaries(session, {parent_id: (1, now)})
 
-            # ! leave the boolean operand '==' as 'is' doesn't work.
-            query = session.query(Posts).filter(
-                Posts.parent_id == None
-            )  # Threads have no parent_id  # noqa: E711
-            
+        return post.id
+
+    def _import_posts(
+        self, posts: List[dict], refs: dict = None, session=None
+    ) -> List[dict]:
+        """
+        Inserts many posts in one transaction with a few executemany INSERTs.
 
-            if section_id is not None:
-                print("searching for section_id =", section_id)
-                query = query.filter(Posts.section_id == section_id)
+        A post can name its parent with ``parent_id`` (an existing post) or
+        with ``parent_ref``, the ``ref`` of a post earlier in the same import.
+        Invalid posts are skipped and reported, the others are inserted.
 
-            if ascending:
-                query = query.order_by(Posts.date.asc())
+        Args:
+            posts: Dicts with the columns of Posts, ``date`` is optional, plus
+                the optional ``ref`` and ``parent_ref`` keys.
+            refs: ref -> post id of the posts imported by previous batches,
+                updated with the refs of this batch.
+
+        Returns:
+            One dict per post, in order, {"post_id": int} or {"error": str}.
+        """
+        refs = {} if refs is None else refs
+        results = [None] * len(posts)
+
+        sections = set(
+            rows_in(session, Sections.id, [p.get("section_id") for p in posts])
+        )
+        users = set(rows_in(session, Users.id, [p.get("user_id") for p in posts]))
+        parents = dict(
+            rows_in(
+                session,
+                Posts.id,
+                [p.get("parent_id") for p in posts],
+                Posts.parent_id,
+            )
+        )
+
+        # posts whose parent is in the batch wait for it in the next level
+        now = utcnow()
+        levels = []
+        batch_refs = {}
+        for i, post in enumerate(posts):
+            ref, parent_ref = post.get("ref"), post.get("parent_ref")
+            error = None
+            level = 0
+
+            if post.get("section_id") not in sections:
+                error = f"no section with id = {post.get('section_id')}"
+            elif post.get("user_id") is not None and post["user_id"] not in users:
+                error = f"no user with id = {post['user_id']}"
+            elif ref is not None and (ref in refs or ref in batch_refs):
+                error = f"duplicate ref {ref!r}"
+            elif parent_ref is not None and post.get("parent_id") is not None:
+                error = "parent_id and parent_ref are exclusive"
+            elif parent_ref is not None and parent_ref not in refs:
+                if parent_ref not in batch_refs:
+                    error = f"unknown parent_ref {parent_ref!r}"
+                elif results[batch_refs[parent_ref]] is not None:
+                    error = f"parent_ref {parent_ref!r} was not imported"
+                else:
+                    level = levels[batch_refs[parent_ref]] + 1
+            elif post.get("parent_id") is not None and post["parent_id"] not in parents:
+                error = f"no post with id = {post['parent_id']}"
+
+            if ref is not None and ref not in refs:
+                batch_refs.setdefault(ref, i)
+            levels.append(level)
+            if error is not None:
+                results[i] = {"error": error}
+
+        columns = ("title", "user_id", "content", "image_uuid", "section_id")
+        posts_table = Posts.__table__
+        # sort_by_parameter_order would send one INSERT per row to SQLite,
+        # the autoincrement ids of a multi row INSERT follow the row order
+        # anyway, so the sorted ids are matched to the rows instead
+        insert_posts = insert(posts_table).returning(posts_table.c.id)
+
+        ids = [None] * len(posts)
+        rows = [None] * len(posts)
+        for level in range(max(levels, default=-1) + 1):
+            batch = [
+                i for i in range(len(posts)) if levels[i] == level and not results[i]
+            ]
+            if not batch:
+                continue
+
+            for i in batch:
+                post = posts[i]
+                row = {column: post.get(column) for column in columns}
+                row["date"] = post.get("date") or now
+                if post.get("parent_ref") is not None:
+                    parent_ref = post["parent_ref"]
+                    row["parent_id"] = (
+                        refs[parent_ref]
+                        if parent_ref in refs
+                        else ids[batch_refs[parent_ref]]
+                    )
+                else:
+                    row["parent_id"] = post.get("parent_id")
+                rows[i] = row
+
+            inserted = session.execute(insert_posts, [rows[i] for i in batch])
+            for i, post_id in zip(batch, sorted(inserted.scalars())):
+                ids[i] = post_id
+                results[i] = {"post_id": post_id}
+                parents[post_id] = rows[i]["parent_id"]
+
+        for ref, i in batch_refs.items():
+            if ids[i] is not None:
+                refs[ref] = ids[i]
+
+        # parents resolved through the refs of previous batches
+        unknown = [
+            row["parent_id"]
+            for row in rows
+            if row is not None and row["parent_id"] not in parents
+        ]
+        parents.update(rows_in(session, Posts.id, unknown, Posts.parent_id))
+
+        # counters, scores and summaries, aggregated so each row is written once
+        thread_counts = {}
+        reply_counts = {}
+        scores = {}
+        new_threads = {}
+        # thread id -> (direct replies, date of the latest)
+        summary_replies = {}
+        for i, row in enumerate(rows):
+            if row is None:
+                continue
+            term = self.hot_term(timestamp_of(row["date"]))
+            if row["parent_id"] is None:
+                section_id = row["section_id"]
+                thread_counts[section_id] = thread_counts.get(section_id, 0) + 1
+                new_threads[ids[i]] = section_id
+                reply_counts.setdefault(ids[i], 0)
+                scores[ids[i]] = term
             else:
-                query = query.order_by(Posts.date.desc())
+                parent_id = row["parent_id"]
+                reply_counts[parent_id] = reply_counts.get(parent_id, 0) + 1
+                # replies to replies do not count for the hot score
+                if parents.get(parent_id, 0) is None:
+                    scores[parent_id] = (
+                        logaddexp(scores[parent_id], term)
+                        if parent_id in scores
+                        else term
+                    )
+                    count, last = summary_replies.get(parent_id, (0, row["date"]))
+                    summary_replies[parent_id] = (count + 1, max(last, row["date"]))
 
-            threads = query.offset(page * size).limit(size).all()
-            print("found", len(threads), "threads")
+        self._add_to_counters(
+            session,
+            SectionStats,
+            SectionStats.section_id,
+            SectionStats.thread_count,
+            thread_counts,
+        )
+        self._add_to_counters(
+            session,
+            ThreadStats,
+            ThreadStats.thread_id,
+            ThreadStats.reply_count,
+            reply_counts,
+        )
 
-            return threads
-        
-        return _get_threads
+        if new_threads:
+            session.execute(
+                insert(ThreadScores.__table__),
+                [
+                    {
+                        "thread_id": thread_id,
+                        "section_id": section_id,
+                        "score": scores[thread_id],
+                    }
+                    for thread_id, section_id in new_threads.items()
+                ],
+            )
 
-    @property
-    def get_post_max_pages(self):
-        @self.SM.session_management()
-        def _get_post_max_pages(
-            section_id=None, parent_id=None, size=50, session=None
-        ):
-            query = session.query(func.count(Posts.id))
+            thread_rows = [
+                (ids[i], row)
+                for i, row in enumerate(rows)
+                if row is not None and ids[i] in new_threads
+            ]
+            authors = dict(
+                rows_in(
+                    session,
+                    Users.id,
+                    [row["user_id"] for _, row in thread_rows],
+                    Users.username,
+                )
+            )
+            summaries = []
+            for thread_id, row in thread_rows:
+                count, last = summary_replies.pop(thread_id, (0, None))
+                summaries.append(
+                    {
+                        "thread_id": thread_id,
+                        "section_id": row["section_id"],
+                        "reply_count": count,
+                        "last_reply_at": last,
+                        "bumped_at": max(row["date"], last or row["date"]),
+                        "author_name": authors.get(row["user_id"]),
+                    }
+                )
+            session.execute(insert(ThreadSummaries.__table__), summaries)
+        # the remaining ones were imported earlier
+        self._bump_summaries(session, summary_replies)
+        self._bump_scores(
+            session,
+            {
+                thread_id: term
+                for thread_id, term in scores.items()
+                if thread_id not in new_threads
+            },
+        )
 
-            if section_id is not None:
-                query = query.filter(Posts.section_id == section_id)
+        return results
 
-            if parent_id is not None:
-                query = query.filter(Posts.parent_id == parent_id)
+    def _get_threads(
+        self,
+        section_id: int = None,
+        page: int = 0,
+        size: int = 50,
+        ascending: bool = False,
+        cursor: str = None,
+        page_amount: int = None,
+        session: Session=None,
+    ):
+        """
+        Lists threads in bump order, the most recently replied first unless
+        ``ascending``.
 
-            total_threads = query.scalar()
+        Returns:
+            Rows with the columns of Posts plus ``username``, ``email``,
+            ``reply_count``, ``last_reply_at`` and ``bumped_at``.
+        """
+        if size <= 0:
+            raise ValueError("size must be > 0")
 
-            if total_threads is None:
-                return -1
+        if cursor is None:
+            # callers that already know the page amount can pass it along
+            if page_amount is None:
+                page_amount = self._get_post_max_pages(
+                    section_id=section_id, size=size, session=session
+                )
+            if page < 0 or page >= page_amount:
+                raise ValueError(f"Page must be >= 0 and < {page_amount}")
+
+        # a range of the bump index of the summaries, each joined to its post
+        # and author by primary key
+        query = (
+            session.query(
+                Posts.id,
+                Posts.title,
+                Posts.user_id,
+                Posts.content,
+                Posts.image_uuid,
+                Posts.section_id,
+                Posts.parent_id,
+                Posts.date,
+                ThreadSummaries.author_name.label("username"),
+                Users.email,
+                ThreadSummaries.reply_count,
+                ThreadSummaries.last_reply_at,
+                ThreadSummaries.bumped_at,
+            )
+            .select_from(ThreadSummaries)
+            .join(Posts, Posts.id == ThreadSummaries.thread_id)
+            .outerjoin(Users, Users.id == Posts.user_id)
+        )
+
+        if section_id is not None:
+            query = query.filter(ThreadSummaries.section_id == section_id)
+
+        key = (ThreadSummaries.bumped_at, ThreadSummaries.thread_id)
+        if cursor is not None:
+            threads = keyset_paginate(
+                query, ThreadSummaries, cursor, size, ascending, key
+            )
+        else:
+            query = query.order_by(*listing_order(ThreadSummaries, ascending, key))
+            threads = query.offset(page * size).limit(size).all()
+        logger.debug("found %d threads in section %s", len(threads), section_id)
+
+        return threads
+
+    def _get_post_max_pages(
+        self, section_id=None, parent_id=None, size=50, session=None
+    ):
+        # reads the maintained counters instead of counting the posts
+        if parent_id is not None:
+            total = (
+                session.query(ThreadStats.reply_count)
+                .filter(ThreadStats.thread_id == parent_id)
+                .scalar()
+            )
+        elif section_id is not None:
+            total = (
+                session.query(SectionStats.thread_count)
+                .filter(SectionStats.section_id == section_id)
+                .scalar()
+            )
+        else:
+            total = session.query(func.sum(SectionStats.thread_count)).scalar()
+
+        if total is None:
+            total = 0
+
+        return (total + size - 1) // size
 
-            return (total_threads + size - 1) // size
-        
-        return _get_post_max_pages
-        
-    @property    
-    def get_thread_by_id(self):
-        @self.SM.session_management()
-        def _get_thread_by_id(thread_id, session=None):
-            thread = session.query(Posts).filter(Posts.id == thread_id).first()
-            return thread
-        
-        return _get_thread_by_id
-
-    @property
-    def delete_thread_by_id(self):
-        @self.SM.session_management(auto_commit=True)
-        def _delete_thread_by_id(thread_id, session=None):
-            thread = session.query(Posts).filter(Posts.id == thread_id).first()
-            if thread:
-                session.delete(thread)
-                session.commit()
         
-        return _delete_thread_by_id
+    def _get_thread_by_id(self, thread_id, session=None):
+        thread = session.query(Posts).filter(Posts.id == thread_id).first()
+        return thread
+
+    def _delete_thread_by_id(self, thread_id, session=None):
+        thread = session.query(Posts).filter(Posts.id == thread_id).first()
+        if thread:
+            if thread.parent_id is None:
+                self._add_to_counter(
+                    session,
+                    SectionStats,
+                    SectionStats.section_id,
+                    thread.section_id,
+                    SectionStats.thread_count,
+                    -1,
+                )
+                session.query(ThreadStats).filter(
+                    ThreadStats.thread_id == thread.id
+                ).delete()
+                session.query(ThreadScores).filter(
+                    ThreadScores.thread_id == thread.id
+                ).delete()
+                session.query(ThreadSummaries).filter(
+                    ThreadSummaries.thread_id == thread.id
+                ).delete()
+            else:
+                self._add_to_counter(
+                    session,
+                    ThreadStats,
+                    ThreadStats.thread_id,
+                    thread.parent_id,
+                    ThreadStats.reply_count,
+                    -1,
+                )
+                self._bump_score(
+                    session,
+                    thread.parent_id,
+                    self.hot_term(timestamp_of(thread.date)),
+                    add=False,
+                )
+                self._unbump_summary(session, thread.parent_id, thread.id)
+            session.delete(thread)
+
     
 
     
-    @property
-    def update_thread_by_id(self):
-        @self.SM.session_management(auto_commit=True)
-        def _update_thread_by_id(thread_id, title, username, content, image_uuid, section_id, session=None):
-            thread = session.query(Posts).filter(Posts.id == thread_id).first()
-            thread.title = title
-            thread.username = username
-            thread.content = content
-            thread.image_uuid = image_uuid
-            thread.section_id = section_id
-            session.commit()
-        
-        return _update_thread_by_id
+    def _update_thread_by_id(
+        self, thread_id, title, username, content, image_uuid, section_id, session=None
+    ):
+        thread = session.query(Posts).filter(Posts.id == thread_id).first()
+        thread.title = title
+        thread.username = username
+        thread.content = content
+        thread.image_uuid = image_uuid
+        thread.section_id = section_id
+        session.commit()
+
         
     
         
-    @property
-    def get_comments_by_thread_id(self):
-        @self.SM.session_management()
-        def _get_comments_by_thread_id(parent_id, page=0, size=50, session=None):
-            if size < 0:
-                raise ValueError("size must be >= 0")
-
-            if self.get_post_max_pages(parent_id=parent_id, size=size) == 0:
-                return []
-
-            if page < 0 or page >= self.get_post_max_pages(parent_id=parent_id, size=size):
-                raise ValueError(
-                    f"Page must be >= 0 and < {self.get_post_max_pages(parent_id=parent_id, size=size)}"
-                )
+    def _get_comments_by_thread_id(
+        self, parent_id, page=0, size=50, ascending=False, cursor=None, session=None
+    ):
+        if size < 0:
+            raise ValueError("size must be >= 0")
 
-            query = session.query(Posts).filter(Posts.parent_id == parent_id)
+        query = session.query(Posts).filter(Posts.parent_id == parent_id)
 
-            query.order_by(Posts.date.desc())
+        if cursor is not None:
+            return keyset_paginate(query, Posts, cursor, size, ascending)
 
-            comments = query.offset(page * size).limit(size).all()
+        page_amount = self._get_post_max_pages(
+            parent_id=parent_id, size=size, session=session
+        )
+        if page_amount == 0:
+            return []
 
-            ret_comments = []
-            for c in comments:
-                ret_comments.append(c)
+        if page < 0 or page >= page_amount:
+            raise ValueError(f"Page must be >= 0 and < {page_amount}")
+
+        if ascending:
+            query = query.order_by(Posts.date.asc(), Posts.id.asc())
+        else:
+            query = query.order_by(Posts.date.desc(), Posts.id.desc())
+
+        comments = query.offset(page * size).limit(size).all()
+
+        ret_comments = []
+        for c in comments:
+            ret_comments.append(c)
+
+        return ret_comments
+
+    def _get_thread_view(
+        self, post_id, page=0, size=50, ascending=False, cursor=None, session=None
+    ) -> Tuple[Union[Row, None], List[Row]]:
+        """
+        Reads a post, one page of its replies and their authors in one query.
+
+        The post and the replies are selected with a UNION ALL, each joined to
+        its author, and come back as plain rows: no ORM object is built.
+
+        Args:
+            post_id: The id of the post.
+            page: The page of replies, ignored when a cursor is given.
+            size: The number of replies per page.
+            ascending: The order of the replies.
+            cursor: A cursor returned by page_cursors.
+
+        Returns:
+            (post, replies), rows with the columns of Posts plus ``username``.
+            The post is None if it does not exist.
+        """
+        if size <= 0:
+            raise ValueError("size must be > 0")
+        if cursor is None and page < 0:
+            raise ValueError("Page must be >= 0")
+
+        columns = (
+            Posts.id,
+            Posts.title,
+            Posts.user_id,
+            Posts.content,
+            Posts.image_uuid,
+            Posts.section_id,
+            Posts.parent_id,
+            Posts.date,
+            Users.username,
+        )
+
+        replies = (
+            select(*columns, null().label("reply_count"))
+            .outerjoin(Users, Users.id == Posts.user_id)
+            .where(Posts.parent_id == post_id)
+        )
+        if cursor is not None:
+            condition, order = keyset_condition(Posts, cursor, ascending)
+            replies = replies.where(condition).order_by(*order)
+        else:
+            replies = replies.order_by(*listing_order(Posts, ascending))
+            replies = replies.offset(page * size)
+        replies = replies.limit(size).subquery()
+
+        post = (
+            select(*columns, ThreadStats.reply_count)
+            .outerjoin(Users, Users.id == Posts.user_id)
+            .outerjoin(ThreadStats, ThreadStats.thread_id == Posts.id)
+            .where(Posts.id == post_id)
+        )
+
+        thread = None
+        comments = []
+        for row in session.execute(union_all(post, select(replies))):
+            if row.id == post_id:
+                thread = row
+            else:
+                comments.append(row)
+
+        if thread is None:
+            return None, []
+
+        if cursor is None:
+            page_amount = ((thread.reply_count or 0) + size - 1) // size
+            if page_amount and page >= page_amount:
+                raise ValueError(f"Page must be >= 0 and < {page_amount}")
+
+        # a UNION has no order of its own
+        comments.sort(key=lambda row: (row.date, row.id), reverse=not ascending)
+
+        return thread, comments
 
-            return ret_comments
-        
-        return _get_comments_by_thread_id
     
-    @property
-    def create_section(self):
-        @self.SM.session_management(auto_commit=True)
-        def _create_section(section_name, session=None):
-            section = Sections(section_name=section_name)
-            session.add(section)
-            session.commit()
-        
-        return _create_section
+    def _create_section(self, section_name, session=None):
+        section = Sections(section_name=section_name)
+        session.add(section)
+        session.flush()
+        self._invalidate(session, "sections", f"section:{section.id}")
+        session.commit()
+
             
 
     
-    @property
-    def get_all_sections(self):
-        @self.SM.session_management()
-        def _get_all_sections(session=None):
+    def _get_all_sections(self, session=None):
+        def load():
             sections = session.query(Sections).all()
             ret_sections = []
             for s in sections:
-                ret_sections.append(s)
+                ret_sections.append(self.section_to_dict(s))
 
             return ret_sections
-        return _get_all_sections
 
-    @property
-    def get_random_motd(self):
-        @self.SM.session_management()
-        def _get_random_motd(session=None):
-            import random
+        return self._cached("sections", load)
 
-            motds = session.query(Motds).all()
-            motd = random.choice(motds)
-            return motd
-        
-        return _get_random_motd
+    @staticmethod
+    def section_to_dict(section: Sections) -> dict:
+        return {
+            "id": section.id,
+            "section_name": section.section_name,
+            "image_uuid": section.image_uuid,
+        }
 
-    @property
-    def get_random_post(self):
-        @self.SM.session_management()
-        def _get_random_post(session=None):
-            import random
+    def _get_random_motd(self, session=None):
+        import random
 
-            posts = session.query(Posts).all()
-            post = random.choice(posts)
-            return post
-        
-        return _get_random_post
+        # the motds are few and rarely change, keep them in memory
+        if self._motds is None or time.monotonic() >= self._motds_expire_at:
+            self._motds = session.query(Motds).all()
+            self._motds_expire_at = time.monotonic() + self.motd_refresh_seconds
+
+        if not self._motds:
+            return None
+        return random.choice(self._motds)
 
-    @property
-    def get_section_by_id(self):
-        @self.SM.session_management()
-        def _get_section_by_id(section_id, session=None):
+    def _create_motd(self, motd, session=None):
+        session.add(Motds(motd=motd))
+        session.commit()
+        self._motds = None
+
+    def _get_random_post(self, session=None):
+        import random
+
+        # pick a random id in [min, max] and take the closest existing post,
+        # both are primary key lookups whatever the size of the table
+        min_id, max_id = session.query(
+            func.min(Posts.id), func.max(Posts.id)
+        ).one()
+        if min_id is None:
+            return None
+
+        target = random.randint(min_id, max_id)
+        post = (
+            session.query(Posts)
+            .filter(Posts.id >= target)
+            .order_by(Posts.id.asc())
+            .first()
+        )
+        if post is None:
+            post = (
+                session.query(Posts)
+                .filter(Posts.id < target)
+                .order_by(Posts.id.desc())
+                .first()
+            )
+        return post
+
+    def _get_popular_threads(self, size=10, section_id=None, session=None):
+        # reads the top of the score index, no scan of the posts
+        query = (
+            session.query(Posts)
+            .join(ThreadScores, ThreadScores.thread_id == Posts.id)
+            .options(joinedload(Posts.user))
+        )
+        if section_id is not None:
+            query = query.filter(ThreadScores.section_id == section_id)
+
+        return query.order_by(ThreadScores.score.desc()).limit(size).all()
+
+    def _get_section_by_id(self, section_id, session=None):
+        def load():
             section = session.query(Sections).filter(Sections.id == section_id).first()
-            return section
-        
-        return _get_section_by_id
-        
+            return self.section_to_dict(section) if section is not None else None
+
+        return self._cached(f"section:{section_id}", load)
+
         
-    @property
-    def register_user(self):
-        @self.SM.session_management(auto_commit=True)
-        def _register_user(username, password, email, session=None):
-            import hashlib
-
-            md5_passwd = hashlib.md5(password.encode()).hexdigest()
-            user = Users(username=username, password=md5_passwd, email=email)
-            session.add(user)
-            session.commit()
-            return user.id
         
-        return _register_user
+    def _register_user(self, username, password_hash, email, session=None):
+        # hashing is slow on purpose, callers do it outside of the session,
+        # see Utils.Passwords
+        user = Users(username=username, password=password_hash, email=email)
+        session.add(user)
+        session.flush()
+        self._invalidate(session, f"user:{user.id}", f"username:{username}")
+        session.commit()
+        return user.id
+
     
-    @property
-    def get_user_by_username(self):
-        @self.SM.session_management()
-        def _get_user_by_username(username, session=None):
+    def _get_user_by_username(self, username, session=None):
+        def load():
             user = session.query(Users).filter(Users.username == username).first()
-            return {
-                "id": user.id,
-                "username": user.username,
-                "email": user.email,
-            }
-        
-        return _get_user_by_username
+            return self.user_to_dict(user) if user is not None else None
+
+        return self._cached(f"username:{username}", load)
+
     
-    @property
-    def get_user_by_id(self):
-        @self.SM.session_management()
-        def _get_user_by_id(user_id, session=None):
+    @staticmethod
+    def user_to_dict(user: Users) -> dict:
+        return {
+            "id": user.id,
+            "username": user.username,
+            "email": user.email,
+        }
+
+    def _get_user_by_id(self, user_id, session=None):
+        def load():
             user = session.query(Users).filter(Users.id == user_id).first()
-            return {
-                "id": user.id,
-                "username": user.username,
-                "email": user.email,
-            }
-        
-        return _get_user_by_id
+            return self.user_to_dict(user) if user is not None else None
+
+        return self._cached(f"user:{user_id}", load)
+
     
-    @property
-    def check_user_existence(self):
-        @self.SM.session_management()
-        def _check_user_existence(username, session=None):
-            user = session.query(Users).filter(Users.username == username).first()
-            return user is not None
-        
-        return _check_user_existence
-        
-        
+    def _get_password_hash(self, username, session=None) -> Union[tuple, None]:
+        """
+        Returns:
+            (user id, stored password hash), None if the user does not exist.
+        """
+        row = (
+            session.query(Users.id, Users.password)
+            .filter(Users.username == username)
+            .first()
+        )
+        return tuple(row) if row is not None else None
+
+    def _update_password_hash(self, user_id, password_hash, session=None):
+        session.query(Users).filter(Users.id == user_id).update(
+            {Users.password: password_hash}, synchronize_session=False
+        )
+
+    def _check_user_existence(self, username, session=None):
+        user = session.query(Users).filter(Users.username == username).first()
+        return user is not None
+
+    def _get_image_by_raw_hash(self, raw_hash, session=None):
+        source = (
+            session.query(ImageSources)
+            .filter(ImageSources.raw_hash == raw_hash)
+            .first()
+        )
+        if source is None:
+            return None
+        return source.image_id
+
+    def _add_image_reference(self, image_id, raw_hash=None, session=None) -> int:
+        # concurrent uploads of the same new image can all miss the row, the
+        # ones losing the insert count as one more reference instead
+        images = session.query(Images).filter(Images.id == image_id)
+        increment = {Images.ref_count: Images.ref_count + 1}
+        if not images.update(increment, synchronize_session=False):
+            inserted = self._insert_if_missing(
+                session, Images, {"id": image_id, "ref_count": 1}
+            )
+            if not inserted:
+                images.update(increment, synchronize_session=False)
+
+        if raw_hash is not None:
+            self._insert_if_missing(
+                session, ImageSources, {"raw_hash": raw_hash, "image_id": image_id}
+            )
+
+        ref_count = images.with_entities(Images.ref_count).scalar()
+        session.commit()
+        return ref_count
+
+    def _release_image(self, image_id, session=None) -> Union[int, None]:
+        """
+        Drops one reference to a stored image.
+
+        Returns:
+            The remaining reference count, None if the image is unknown.
+            When it reaches 0 the row is removed and the file can be deleted.
+        """
+        image = session.query(Images).filter(Images.id == image_id).first()
+        if image is None:
+            return None
+
+        image.ref_count -= 1
+        ref_count = image.ref_count
+        if ref_count <= 0:
+            session.query(ImageSources).filter(
+                ImageSources.image_id == image_id
+            ).delete()
+            session.delete(image)
+
+        session.commit()
+        return ref_count
+
+
 
     def close(self):
+        close_all_sessions()
         self.engine.dispose()
-        self.session_maker.close_all()
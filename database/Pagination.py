@@ -0,0 +1,135 @@
+import base64
+from datetime import datetime
+from typing import List, Tuple, Union
+from sqlalchemy import tuple_
+from sqlalchemy.orm import Query
+
+NEXT = "n"
+PREV = "p"
+
+
+def encode_cursor(date: datetime, post_id: int, direction: str) -> str:
+    value = f"{direction}:{post_id}:{date.isoformat()}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int, str]:
+    try:
+        direction, post_id, date = (
+            base64.urlsafe_b64decode(cursor.encode()).decode().split(":", 2)
+        )
+        post_id = int(post_id)
+        date = datetime.fromisoformat(date)
+    except Exception:
+        raise ValueError("invalid cursor")
+
+    if direction not in (NEXT, PREV):
+        raise ValueError("invalid cursor")
+
+    return date, post_id, direction
+
+
+def listing_key(model, key: tuple = None) -> tuple:
+    # (date, id) columns a listing is ordered by, the model's own by default
+    return key if key is not None else (model.date, model.id)
+
+
+def listing_order(model, ascending: bool = False, key: tuple = None) -> tuple:
+    date, id = listing_key(model, key)
+    if ascending:
+        return date.asc(), id.asc()
+    return date.desc(), id.desc()
+
+
+def keyset_condition(
+    model, cursor: str, ascending: bool = False, key: tuple = None
+) -> tuple:
+    """
+    Builds the filter and the ordering of the page a cursor points to.
+
+    Rows come out in walking order, which is the reverse of the listing order
+    for a previous page cursor.
+
+    The rows are compared with the key of the anchor row as it was when the
+    cursor was made, so a page does not move when its anchor is bumped.
+
+    Args:
+        key: The (date, id) columns to page on, defaults to those of model.
+
+    Returns:
+        (condition, order_by columns)
+    """
+    anchor_date, anchor_id, direction = decode_cursor(cursor)
+    date, id = listing_key(model, key)
+    anchor = (anchor_date, anchor_id)
+
+    # walking backwards is the same query in the opposite order
+    forward = ascending if direction == NEXT else not ascending
+    if forward:
+        return tuple_(date, id) > anchor, listing_order(model, True, key)
+    return tuple_(date, id) < anchor, listing_order(model, False, key)
+
+
+def keyset_paginate(
+    query: Query,
+    model,
+    cursor: str,
+    size: int,
+    ascending: bool = False,
+    key: tuple = None,
+) -> List:
+    """
+    Runs a listing query one page at a time, keyed on (date, id).
+
+    The cursor holds the (date, id) key of the row the page starts from, see
+    keyset_condition.
+
+    Args:
+        query: The filtered query, without ordering.
+        model: The mapped class, it needs ``date`` and ``id`` columns.
+        cursor: A cursor returned by page_cursors.
+        size: Maximum number of rows to return.
+        ascending: The order of the listing.
+        key: The (date, id) columns to page on, defaults to those of model.
+
+    Returns:
+        The rows, in listing order.
+    """
+    condition, order = keyset_condition(model, cursor, ascending, key)
+    rows = query.filter(condition).order_by(*order).limit(size).all()
+    if decode_cursor(cursor)[2] == PREV:
+        rows.reverse()
+
+    return rows
+
+
+def page_cursors(
+    rows: List, size: int, cursor: str = None, page: int = 0, key: str = "date"
+) -> Tuple[Union[str, None], Union[str, None]]:
+    """
+    Builds the cursors of the pages around a page of rows.
+
+    Args:
+        key: The attribute of the rows holding the date the listing is
+            ordered by.
+
+    Returns:
+        (next cursor, previous cursor), None where there is no such page.
+    """
+    if not rows:
+        return None, None
+
+    direction = decode_cursor(cursor)[2] if cursor is not None else None
+    full = len(rows) == size
+
+    has_next = full or direction == PREV
+    if direction is None:
+        has_prev = page > 0
+    else:
+        has_prev = direction == NEXT or full
+
+    first, last = rows[0], rows[-1]
+    return (
+        encode_cursor(getattr(last, key), last.id, NEXT) if has_next else None,
+        encode_cursor(getattr(first, key), first.id, PREV) if has_prev else None,
+    )
@@ -0,0 +1,116 @@
+"""
+Checks that the listing queries of DatabaseManager are served by indexes.
+
+The queries are captured while running the real DatabaseManager methods on a
+scratch SQLite database, then each one is passed to EXPLAIN QUERY PLAN. A full
+scan of any table or a temporary b-tree for sorting is reported as a
+regression.
+
+Usage:
+    python -m database.QueryPlans
+"""
+
+import os
+import sys
+import tempfile
+from typing import List
+from sqlalchemy import event
+
+from database.DatabaseManager import DatabaseManager
+from database.Pagination import NEXT, PREV, encode_cursor
+
+
+def capture_listing_queries(db: DatabaseManager) -> List[tuple]:
+    db.create_section("plans")
+    thread_id = db.create_thread(user_id=None, section_id=1, title="thread")
+    reply_id = db.create_thread(
+        user_id=None, section_id=1, title="reply", parent_id=thread_id
+    )
+
+    thread_date = db.get_threads(section_id=1)[0].bumped_at
+    reply_date = db.get_comments_by_thread_id(thread_id)[0].date
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT") and "posts" in statement:
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", capture)
+    try:
+        for ascending in (False, True):
+            db.get_threads(section_id=1, ascending=ascending)
+            db.get_threads(ascending=ascending)
+            for direction in (NEXT, PREV):
+                db.get_threads(
+                    section_id=1,
+                    ascending=ascending,
+                    cursor=encode_cursor(thread_date, thread_id, direction),
+                )
+                db.get_comments_by_thread_id(
+                    thread_id,
+                    ascending=ascending,
+                    cursor=encode_cursor(reply_date, reply_id, direction),
+                )
+                db.get_thread_view(
+                    thread_id,
+                    ascending=ascending,
+                    cursor=encode_cursor(reply_date, reply_id, direction),
+                )
+            db.get_comments_by_thread_id(thread_id, ascending=ascending)
+            db.get_thread_view(thread_id, ascending=ascending)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", capture)
+
+    return statements
+
+
+def find_plan_problems(db: DatabaseManager, statements: List[tuple]) -> List[str]:
+    problems = []
+
+    with db.engine.connect() as conn:
+        for statement, parameters in statements:
+            plan = conn.exec_driver_sql(
+                "EXPLAIN QUERY PLAN " + statement, parameters
+            ).fetchall()
+            details = [row[-1] for row in plan]
+            # scanning the rows a subquery produced is not a table scan
+            subqueries = {
+                detail.split()[1]
+                for detail in details
+                if detail.startswith(("CO-ROUTINE ", "MATERIALIZE "))
+            }
+
+            for detail in details:
+                full_scan = (
+                    detail.startswith("SCAN ")
+                    and "INDEX" not in detail
+                    and detail.split()[1] not in subqueries
+                )
+                if full_scan or "TEMP B-TREE" in detail:
+                    problems.append(f"{detail}\n    in: {' '.join(statement.split())}")
+
+    return problems
+
+
+def main() -> int:
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+
+    db = DatabaseManager("sqlite:///" + path)
+    try:
+        statements = capture_listing_queries(db)
+        problems = find_plan_problems(db, statements)
+    finally:
+        db.close()
+        os.remove(path)
+
+    for problem in problems:
+        print(problem)
+    print(f"checked {len(statements)} queries, {len(problems)} problems")
+
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,17 +2,35 @@ from sqlalchemy import (
     create_engine,
     Column,
     Integer,
+    Float,
     String,
     Text,
     Sequence,
     DateTime,
     ForeignKey,
+    Index,
     func,
+    inspect,
+    text,
 )
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
+from datetime import datetime, timezone
+import logging
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+# bumped by the one off data migrations of upgrade(), kept in the SQLite
+# user_version pragma
+SQLITE_SCHEMA_VERSION = 1
+
+
+def utcnow() -> datetime:
+    # naive UTC, bound with microseconds like every other date SQLAlchemy writes
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 
 class Posts(Base):
     __tablename__ = "posts"
@@ -27,7 +45,18 @@ class Posts(Base):
     section_id = Column(
         Integer, ForeignKey("sections.id", ondelete="CASCADE"), nullable=False
     )
-    date = Column(DateTime, nullable=False, default=func.current_timestamp())
+    date = Column(DateTime, nullable=False, default=utcnow)
+
+    user = relationship("Users")
+
+    # match the listing queries: threads of a section and replies of a thread,
+    # both ordered by (date, id)
+    __table_args__ = (
+        Index(
+            "ix_posts_section_parent_date_id", "section_id", "parent_id", "date", "id"
+        ),
+        Index("ix_posts_parent_date_id", "parent_id", "date", "id"),
+    )
 
 
 class Sections(Base):
@@ -48,4 +77,119 @@ class Users(Base):
     username = Column(String(128), nullable=False, unique=True)
     password = Column(String(128), nullable=False)
     email = Column(String(128), nullable=False, unique=True)
-    
+
+
+class Images(Base):
+    __tablename__ = "images"
+    # hash of the converted image, also used as its public id
+    id = Column(String(255), primary_key=True)
+    ref_count = Column(Integer, nullable=False, default=0)
+    date = Column(DateTime, nullable=False, default=func.current_timestamp())
+
+
+class ImageSources(Base):
+    __tablename__ = "image_sources"
+    # hash of the uploaded bytes, several uploads can convert to the same image
+    raw_hash = Column(String(255), primary_key=True)
+    image_id = Column(
+        String(255), ForeignKey("images.id", ondelete="CASCADE"), nullable=False
+    )
+
+
+class SectionStats(Base):
+    __tablename__ = "section_stats"
+    section_id = Column(
+        Integer, ForeignKey("sections.id", ondelete="CASCADE"), primary_key=True
+    )
+    thread_count = Column(Integer, nullable=False, default=0)
+
+
+class ThreadStats(Base):
+    __tablename__ = "thread_stats"
+    thread_id = Column(
+        Integer, ForeignKey("posts.id", ondelete="CASCADE"), primary_key=True
+    )
+    reply_count = Column(Integer, nullable=False, default=0)
+
+class ThreadSummaries(Base):
+    __tablename__ = "thread_summaries"
+    # what a listing shows of a thread besides the post itself, maintained by
+    # DatabaseManager so listings never aggregate the replies
+    thread_id = Column(
+        Integer, ForeignKey("posts.id", ondelete="CASCADE"), primary_key=True
+    )
+    section_id = Column(
+        Integer, ForeignKey("sections.id", ondelete="CASCADE"), nullable=False
+    )
+    # direct replies only, like the hot score
+    reply_count = Column(Integer, nullable=False, default=0)
+    last_reply_at = Column(DateTime, nullable=True)
+    # last_reply_at, or the date of the thread while it has no replies
+    bumped_at = Column(DateTime, nullable=False)
+    # username of the author, None for anonymous threads
+    author_name = Column(String(128), nullable=True)
+
+    # bump order listings, per section and across sections
+    __table_args__ = (
+        Index(
+            "ix_thread_summaries_section_bumped",
+            "section_id",
+            "bumped_at",
+            "thread_id",
+        ),
+        Index("ix_thread_summaries_bumped", "bumped_at", "thread_id"),
+    )
+
+
+class ThreadScores(Base):
+    __tablename__ = "thread_scores"
+    thread_id = Column(
+        Integer, ForeignKey("posts.id", ondelete="CASCADE"), primary_key=True
+    )
+    section_id = Column(
+        Integer, ForeignKey("sections.id", ondelete="CASCADE"), nullable=False
+    )
+    # log of the exponentially decayed activity, see DatabaseManager.hot_term
+    score = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index("ix_thread_scores_section_score", "section_id", "score"),
+        Index("ix_thread_scores_score", "score"),
+    )
+
+def upgrade(bind):
+    """
+    Brings an existing database up to date with the models.
+
+    create_all only creates missing tables, this also creates the indexes that
+    were added to tables which already exist.
+
+    Args:
+        bind: A connection, inside a transaction.
+    """
+    Base.metadata.create_all(bind)
+
+    inspector = inspect(bind)
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info("creating index %s on %s", index.name, table.name)
+                index.create(bind)
+
+    if bind.dialect.name == "sqlite":
+        version = bind.exec_driver_sql("PRAGMA user_version").scalar()
+        if version < 1:
+            # CURRENT_TIMESTAMP wrote whole seconds, SQLAlchemy writes
+            # microseconds and SQLite compares the text: keyset cursors need
+            # a single format
+            legacy = bind.execute(
+                text(
+                    "UPDATE posts SET date = date || '.000000' "
+                    "WHERE length(date) = 19"
+                )
+            )
+            if legacy.rowcount:
+                logger.info("normalized the dates of %d posts", legacy.rowcount)
+        if version < SQLITE_SCHEMA_VERSION:
+            bind.exec_driver_sql(f"PRAGMA user_version = {SQLITE_SCHEMA_VERSION}")
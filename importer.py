@@ -0,0 +1,76 @@
+"""
+Imports posts from an NDJSON file, one post per line, as /bulk/posts does.
+
+Each line is a post of /newPost, plus the optional "ref", "parent_ref", "date"
+and "image" keys. "image" is the name of a file of the images directory.
+
+Usage:
+    python importer.py posts.ndjson [--images DIRECTORY] [--batch-size N]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import app
+from Utils.BulkImport import import_posts
+
+
+async def run(path: str, images_directory: str, batch_size: int) -> list:
+    async def store_image_file(name: str) -> str:
+        image_path = os.path.join(images_directory, name)
+        if os.path.basename(name) != name or not os.path.isfile(image_path):
+            raise ValueError(f"image {name} not found in {images_directory}")
+        return await app.import_image_file(name, image_path)
+
+    await app.db.create_tables()
+    try:
+        with open(path, "rb") as f_in:
+            return await import_posts(
+                app.db,
+                f_in,
+                batch_size=batch_size,
+                store_image=store_image_file if images_directory else None,
+                release_image=app.discard_image,
+            )
+    finally:
+        app.image_pool.shutdown()
+        await app.db.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Imports posts from NDJSON.")
+    parser.add_argument("file", help="NDJSON file, one post per line")
+    parser.add_argument("--images", help="directory of the images named by posts")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=app.BULK_IMPORT_BATCH_SIZE,
+        help="posts inserted per transaction",
+    )
+    args = parser.parse_args()
+
+    if args.images:
+        app.initialization()
+
+    start = time.perf_counter()
+    results = asyncio.run(run(args.file, args.images, args.batch_size))
+    elapsed = time.perf_counter() - start
+
+    failed = [result for result in results if "error" in result]
+    for result in failed:
+        print(f"line {result['line']}: {result['error']}", file=sys.stderr)
+
+    imported = len(results) - len(failed)
+    print(
+        f"imported {imported} posts, {len(failed)} failed, "
+        f"in {elapsed:.2f}s ({imported / max(elapsed, 1e-9):.0f} posts/s)"
+    )
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,18 @@
+import logging
 import os
 from io import BytesIO
 from PIL import Image
 
+logger = logging.getLogger(__name__)
+
 
 def required_directories_init(REQUIRED_DIRECTORIES: list):
     for d in REQUIRED_DIRECTORIES:
-        print(f"checking if {d} exists...")
         try:
             os.makedirs(d, exist_ok=False)
-            print(f"{d} created!")
+            logger.info("%s created", d)
         except OSError:
-            print(f"{d} already exists!")
+            logger.debug("%s already exists", d)
 
 
 def check_save_support(image_format: str) -> bool:
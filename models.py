@@ -1,5 +1,6 @@
 from pydantic import BaseModel
 from typing import Union
+from datetime import datetime
 
 
 class Post(BaseModel):
@@ -9,3 +10,13 @@ class Post(BaseModel):
     content: Union[str, None] = None
     image_uuid: Union[str, None] = None
     parent_id: Union[int, None] = None
+
+
+class ImportedPost(Post):
+    # ids local to an import, a post names its parent with the ref of an
+    # earlier post of the same import
+    ref: Union[str, int, None] = None
+    parent_ref: Union[str, int, None] = None
+    date: Union[datetime, None] = None
+    # file name of an image sent along with the posts
+    image: Union[str, None] = None
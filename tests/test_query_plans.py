@@ -0,0 +1,18 @@
+import pytest
+
+from database.DatabaseManager import DatabaseManager
+from database.QueryPlans import capture_listing_queries, find_plan_problems
+
+
+@pytest.fixture
+def db(tmp_path):
+    manager = DatabaseManager("sqlite:///" + str(tmp_path / "plans.db"))
+    yield manager
+    manager.close()
+
+
+def test_listing_queries_use_indexes(db):
+    statements = capture_listing_queries(db)
+
+    assert statements
+    assert find_plan_problems(db, statements) == []